@@ -0,0 +1,58 @@
+# audio.py
+import os
+import threading
+import subprocess
+
+from moviepy.config import get_setting
+
+# Whisper resamples to 16 kHz mono anyway, so anything richer is wasted upload
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_BITRATE = "32k"
+AUDIO_FILENAME = "audio.mp3"
+
+# ffmpeg processes allowed at once, across all threads (defaults to one per core)
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", os.cpu_count() or 1))
+audio_slots = threading.BoundedSemaphore(AUDIO_WORKERS)
+
+def _ffmpeg_cmd(video_path: str, max_seconds: float = None) -> list:
+    cmd = [get_setting("FFMPEG_BINARY"), "-nostdin", "-loglevel", "error"]
+    if max_seconds is not None:
+        cmd += ["-t", str(max_seconds)]
+    cmd += [
+        "-i", video_path,
+        "-vn", "-sn", "-dn",
+        "-ac", "1",
+        "-ar", str(AUDIO_SAMPLE_RATE),
+        "-c:a", "libmp3lame",
+        "-b:a", AUDIO_BITRATE,
+        "-f", "mp3",
+    ]
+    return cmd
+
+def audio_seconds(audio_bytes: bytes) -> float:
+    """Duration of MP3 bytes from extract_audio (constant bitrate, so size / rate)."""
+    return len(audio_bytes) * 8 / (int(AUDIO_BITRATE.rstrip("k")) * 1000)
+
+def extract_audio(video_path: str, max_seconds: float = None) -> bytes:
+    """Decode only the audio stream of a video to compact mono MP3 bytes, in memory.
+
+    If max_seconds is set, ffmpeg stops reading the input after that long, so
+    long videos cost no more decoding (or Whisper minutes) than the cap.
+    """
+    cmd = _ffmpeg_cmd(video_path, max_seconds) + ["pipe:1"]
+    with audio_slots:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0 or len(proc.stdout) == 0:
+        raise RuntimeError(f"ffmpeg could not extract audio from {video_path}: "
+                           f"{proc.stderr.decode(errors='replace').strip()}")
+    return proc.stdout
+
+def extract_audio_to_file(video_path: str, audio_path: str, max_seconds: float = None) -> str:
+    """Like extract_audio, but writes the MP3 to audio_path and returns the path."""
+    cmd = _ffmpeg_cmd(video_path, max_seconds) + ["-y", audio_path]
+    with audio_slots:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not extract audio from {video_path}: "
+                           f"{proc.stderr.decode(errors='replace').strip()}")
+    return audio_path
@@ -0,0 +1,448 @@
+# benchmark.py
+"""Offline throughput benchmark for the roach crawl.
+
+Starts two local stand-in servers: one serves synthetic TikTok video pages and
+MP4s, the other is an OpenAI-compatible transcription/chat endpoint. The
+stand-ins have configurable latency and 429 injection. The script then runs a
+fresh crawl against them in a temporary directory and prints per-stage latency
+percentiles and videos/minute.
+
+Comment lists and user video lists normally come through TikTokApi's headless
+browser, which can't be pointed at a local server, so they are seeded into the
+pyktok response cache instead.
+
+    python benchmark.py --users 30 --cycles 2 --openai-latency 0.5 --openai-429-rate 0.05
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlunsplit
+
+ROACH_AUTHOR = "roach_author"
+FIRST_VIDEO_ID = 7300000000000000000
+# extract_comments() asks for this many comments per video
+COMMENT_COUNT = 30
+
+# Transcripts the stand-in Whisper returns. The "bad" ones paraphrase known
+# narratives so they reach the chat endpoint even with USE_PRECLASSIFIER=1.
+BAD_TRANSCRIPTS = [
+    "Ukraine has always been part of Russia and the special military operation is a liberation of the Ukrainian people.",
+    "The Ukrainian government and military are neo-Nazis and Ukraine is a threat to Russia.",
+    "The Russian language and culture are banned in Ukraine, and the West is using Ukraine against Russia.",
+]
+BENIGN_TRANSCRIPTS = [
+    "Today we are making a quick weeknight pasta with garlic, lemon and a lot of parmesan cheese.",
+    "Here are three stretches you can do at your desk to loosen up your shoulders and back.",
+    "We drove up the coast this weekend and found the best little taco stand right by the beach.",
+]
+PROPAGANDA_MARKERS = ("russia", "ukrain")
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return float("nan")
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class StageTimer:
+    """Collects (stage, seconds, error) observations from the crawl."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, error):
+        with self._lock:
+            self.seconds.setdefault(stage, []).append(seconds)
+            if error is not None:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def completed(self, stage: str) -> int:
+        with self._lock:
+            return len(self.seconds.get(stage, [])) - self.errors.get(stage, 0)
+
+    def summary(self) -> dict:
+        with self._lock:
+            summary = {}
+            for stage, values in self.seconds.items():
+                values = sorted(values)
+                summary[stage] = {
+                    "calls": len(values),
+                    "errors": self.errors.get(stage, 0),
+                    "mean": sum(values) / len(values),
+                    "p50": percentile(values, 50),
+                    "p90": percentile(values, 90),
+                    "p99": percentile(values, 99),
+                }
+            return summary
+
+
+### Synthetic TikTok
+
+class FakeTikTok:
+    """A small random comment graph: users, their videos, and who commented where."""
+
+    def __init__(self, n_users: int, videos_per_user: int, comments_per_video: int,
+                 clip_seconds: float, seed: int):
+        rng = random.Random(seed)
+        self.clip_seconds = clip_seconds
+        self.usernames = [ROACH_AUTHOR] + [f"user{i}" for i in range(n_users)]
+        self.videos = {}  # video id -> item dict (the page JSON's itemStruct)
+        self.videos_by_user = {}
+        self.comments = {}  # video id -> list of TikTokApi-style comment dicts
+        next_id = FIRST_VIDEO_ID
+        for username in self.usernames:
+            self.videos_by_user[username] = []
+            for _ in range(videos_per_user):
+                video_id = str(next_id)
+                next_id += 1
+                self.videos[video_id] = self._item(rng, video_id, username)
+                self.videos_by_user[username].append(video_id)
+        for video_id, item in self.videos.items():
+            commenters = rng.sample([u for u in self.usernames if u != item["author"]["uniqueId"]],
+                                    min(comments_per_video, len(self.usernames) - 1))
+            self.comments[video_id] = [self._comment(rng, video_id, n, username)
+                                       for n, username in enumerate(commenters)]
+        self.roach_drop_id = self.videos_by_user[ROACH_AUTHOR][0]
+
+    def _item(self, rng: random.Random, video_id: str, username: str) -> dict:
+        media_url = f"https://v16-webapp.tiktok.com/media/{video_id}.mp4"
+        return {
+            "id": video_id,
+            "createTime": str(1700000000 + rng.randrange(10 ** 6)),
+            "desc": f"video {video_id}",
+            "locationCreated": "US",
+            "isAd": False,
+            "video": {"duration": int(self.clip_seconds), "downloadAddr": media_url, "playAddr": media_url},
+            "stats": {"diggCount": rng.randrange(10 ** 4), "shareCount": rng.randrange(10 ** 3),
+                      "commentCount": rng.randrange(10 ** 3), "playCount": rng.randrange(10 ** 6)},
+            "author": {"uniqueId": username, "nickname": username, "verified": False},
+            "authorStats": {"followerCount": rng.randrange(10 ** 5), "followingCount": rng.randrange(10 ** 3),
+                            "heartCount": rng.randrange(10 ** 6), "videoCount": rng.randrange(10 ** 3),
+                            "diggCount": rng.randrange(10 ** 4)},
+        }
+
+    def _comment(self, rng: random.Random, video_id: str, n: int, username: str) -> dict:
+        return {
+            "cid": f"{video_id}{n:03d}",
+            "text": "so true",
+            "digg_count": rng.choice([0, 0, 1, 3, 12, 150]),
+            "create_time": 1700000000 + rng.randrange(10 ** 6),
+            "is_author_digged": rng.random() < 0.1,
+            "sort_tags": ["top_list"] if rng.random() < 0.1 else [],
+            "user": {"uid": str(zlib.crc32(username.encode())), "unique_id": username},
+        }
+
+    def video_url(self, video_id: str) -> str:
+        return f"https://www.tiktok.com/@{self.videos[video_id]['author']['uniqueId']}/video/{video_id}"
+
+    def page_html(self, video_id: str) -> str:
+        # alternate between the two page layouts pyktok understands
+        item = self.videos[video_id]
+        if int(video_id) % 2 == 0:
+            script_id = "SIGI_STATE"
+            payload = {"ItemModule": {video_id: item},
+                       "UserModule": {"users": {item["author"]["uniqueId"]: {"verified": False}}}}
+        else:
+            script_id = "__UNIVERSAL_DATA_FOR_REHYDRATION__"
+            payload = {"__DEFAULT_SCOPE__": {"webapp.video-detail": {"itemInfo": {"itemStruct": item}}}}
+        return (f'<!DOCTYPE html><html><head><title>TikTok</title></head><body><div id="app"></div>'
+                f'<script id="{script_id}" type="application/json">{json.dumps(payload)}</script>'
+                f'</body></html>')
+
+    def make_clips(self, clip_dir: str):
+        """Render a short MP4 per video, each with a different tone so no two
+        clips share audio (which would turn transcription into cache hits)."""
+        from moviepy.config import get_setting
+        os.makedirs(clip_dir, exist_ok=True)
+        for n, video_id in enumerate(self.videos):
+            subprocess.run([
+                get_setting("FFMPEG_BINARY"), "-nostdin", "-loglevel", "error", "-y",
+                "-f", "lavfi", "-i", f"sine=frequency={200 + 7 * n}:duration={self.clip_seconds}",
+                "-f", "lavfi", "-i", f"color=c=black:s=64x64:r=10:d={self.clip_seconds}",
+                "-shortest", "-c:v", "mpeg4", "-c:a", "aac",
+                os.path.join(clip_dir, f"{video_id}.mp4"),
+            ], check=True)
+
+    def seed_cache(self, cache, videos_per_user: int):
+        """Store what TikTokApi would have returned for user video lists and comments."""
+        for username, video_ids in self.videos_by_user.items():
+            for video_ct in range(1, videos_per_user + 1):
+                cache.put("user_videos", f"user:{username}:{video_ct}",
+                          [self.video_url(video_id) for video_id in video_ids[:video_ct]])
+        for video_id, comments in self.comments.items():
+            cache.put("comments", f"{video_id}:{COMMENT_COUNT}", comments)
+
+
+class StandIn:
+    """Latency and 429 injection shared by both stand-in servers."""
+
+    def __init__(self, latency: float, rate_429: float, seed: int):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.requests = 0
+        self.throttled = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay_or_throttle(self) -> bool:
+        """Sleep for the configured latency; returns True if this request should get a 429."""
+        with self._lock:
+            self.requests += 1
+            jitter = self._rng.uniform(0.5, 1.5)
+            throttle = self._rng.random() < self.rate_429
+            if throttle:
+                self.throttled += 1
+        time.sleep(self.latency * jitter)
+        return throttle
+
+
+def tiktok_handler(world: FakeTikTok, clip_dir: str, stand_in: StandIn):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: bytes, content_type: str, extra_headers: dict = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if stand_in.delay_or_throttle():
+                return self._send(429, b"Too Many Requests", "text/plain", {"Retry-After": "1"})
+            if path.startswith("/media/") and path.endswith(".mp4"):
+                clip_path = os.path.join(clip_dir, os.path.basename(path))
+                if os.path.exists(clip_path):
+                    with open(clip_path, "rb") as f:
+                        return self._send(200, f.read(), "video/mp4")
+            elif "/video/" in path:
+                video_id = path.rsplit("/", 1)[-1]
+                if video_id in world.videos:
+                    return self._send(200, world.page_html(video_id).encode(), "text/html; charset=utf-8")
+            self._send(404, b"Not Found", "text/plain")
+
+    return Handler
+
+
+def openai_handler(stand_in: StandIn, bad_fraction: float):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status: int, payload: dict, extra_headers: dict = None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if stand_in.delay_or_throttle():
+                return self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error",
+                                                       "code": "rate_limit_exceeded"}},
+                                       {"Retry-After": "1"})
+            path = urlsplit(self.path).path
+            if path.endswith("/audio/transcriptions"):
+                # the multipart boundary is random per request; leave it out
+                # so the same clip always gets the same transcript
+                boundary = self.headers.get("Content-Type", "").partition("boundary=")[2].encode()
+                audio_body = body.replace(boundary, b"") if boundary else body
+                return self._send_json(200, {"text": transcript_for(audio_body, bad_fraction)})
+            if path.endswith("/chat/completions"):
+                return self._send_json(200, chat_completion(json.loads(body), len(body)))
+            self._send_json(404, {"error": {"message": f"no route {path}", "type": "invalid_request_error"}})
+
+    return Handler
+
+
+def transcript_for(audio_body: bytes, bad_fraction: float) -> str:
+    """A transcript picked deterministically from the uploaded audio, unique per clip."""
+    digest = hashlib.sha256(audio_body).digest()
+    is_bad = digest[0] / 256 < bad_fraction
+    texts = BAD_TRANSCRIPTS if is_bad else BENIGN_TRANSCRIPTS
+    return f"{texts[digest[1] % len(texts)]} Clip {digest[:4].hex()}."
+
+
+def chat_completion(request: dict, request_bytes: int) -> dict:
+    """Answers every chat call utils.py makes, judging each transcript by keyword."""
+    prompt = request["messages"][-1]["content"]
+
+    def is_propaganda(text: str) -> bool:
+        return any(marker in text.lower() for marker in PROPAGANDA_MARKERS)
+
+    def texts_in(prompt_text: str) -> list:
+        texts = []
+        for chunk in prompt_text.split("<text")[1:]:
+            texts.append(chunk.split(">", 1)[1].split("</text>", 1)[0])
+        return texts
+
+    def judgement(text: str) -> dict:
+        if is_propaganda(text):
+            return {"result": 1, "narratives": [{"narrative_str": "Ukraine is part of Russia", "narrative_number": 2}]}
+        return {"result": 0, "narratives": []}
+
+    schema = (request.get("response_format") or {}).get("json_schema", {}).get("name")
+    texts = texts_in(prompt)
+    if schema == "BatchDisinformationResponse":
+        content = {"results": [{"index": i, **judgement(text)} for i, text in enumerate(texts)]}
+    elif schema == "DisinformationResponseOnlyNarratives":
+        content = {"narratives": judgement(texts[0] if texts else prompt)["narratives"]}
+    elif schema is not None:
+        content = judgement(texts[0] if texts else prompt)
+    elif texts and is_propaganda(texts[0]):
+        content = "Yes, this text contains Russian propaganda."
+    else:
+        content = "No, the text does not contain Russian narratives."
+    content = content if isinstance(content, str) else json.dumps(content)
+    prompt_tokens = request_bytes // 4
+    completion_tokens = len(content) // 4 + 1
+    return {
+        "id": f"chatcmpl-bench-{hashlib.sha256(prompt.encode()).hexdigest()[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "gpt-4o-mini"),
+        "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                     "message": {"role": "assistant", "content": content, "refusal": None}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return server
+
+
+def tiktok_rewriter(base_url: str):
+    """Sends every TikTok page and CDN request to the stand-in server."""
+    from pyktok_local.rate_limit import tiktok_page_hosts, tiktok_cdn_markers
+    base = urlsplit(base_url)
+
+    def rewrite(url: str) -> str:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+        if host in tiktok_page_hosts or any(marker in host for marker in tiktok_cdn_markers):
+            return urlunsplit((base.scheme, base.netloc, parts.path, parts.query, parts.fragment))
+        return url
+
+    return rewrite
+
+
+def print_report(timer: StageTimer, wall_seconds: float, videos_done: int, extra: dict):
+    print(f"\n{'stage':<14}{'calls':>7}{'errors':>8}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}")
+    for stage, row in timer.summary().items():
+        print(f"{stage:<14}{row['calls']:>7}{row['errors']:>8}"
+              f"{row['mean']:>9.3f}{row['p50']:>9.3f}{row['p90']:>9.3f}{row['p99']:>9.3f}")
+    print(f"\nvideos processed: {videos_done} in {wall_seconds:.1f}s "
+          f"({videos_done / (wall_seconds / 60):.1f} videos/minute)")
+    for name, value in extra.items():
+        print(f"{name}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a roach crawl against local stand-in servers.")
+    parser.add_argument("--users", type=int, default=20, help="synthetic users besides the roach drop's author")
+    parser.add_argument("--videos-per-user", type=int, default=2)
+    parser.add_argument("--comments-per-video", type=int, default=8)
+    parser.add_argument("--clip-seconds", type=float, default=3.0)
+    parser.add_argument("--bad-fraction", type=float, default=0.3,
+                        help="share of clips the stand-in Whisper transcribes as propaganda")
+    parser.add_argument("--cycles", type=int, default=2, help="crawl cycles after the roach drop")
+    parser.add_argument("--tiktok-latency", type=float, default=0.2, help="mean seconds per TikTok response")
+    parser.add_argument("--tiktok-429-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="mean seconds per OpenAI response")
+    parser.add_argument("--openai-429-rate", type=float, default=0.0)
+    parser.add_argument("--tiktok-rate", type=float, default=None,
+                        help="override the 'tiktok' rate limit (page fetches per second)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix="roach-bench-")
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    print(f"working in {work_dir}")
+
+    world = FakeTikTok(args.users, args.videos_per_user, args.comments_per_video, args.clip_seconds, args.seed)
+    clip_dir = os.path.join(work_dir, "clips")
+    world.make_clips(clip_dir)
+    tiktok_stand_in = StandIn(args.tiktok_latency, args.tiktok_429_rate, args.seed)
+    openai_stand_in = StandIn(args.openai_latency, args.openai_429_rate, args.seed + 1)
+    tiktok_server = serve(tiktok_handler(world, clip_dir, tiktok_stand_in))
+    openai_server = serve(openai_handler(openai_stand_in, args.bad_fraction))
+
+    # every relative path the crawl writes (data dir, SQLite state, caches)
+    # lands in the working directory
+    os.chdir(work_dir)
+    sys.path.insert(0, repo_dir)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["PYK_BROWSER"] = ""
+
+    import outer_loop
+    from pyktok_local.pyktok import set_url_rewriter, get_layout_counts
+    from pyktok_local.http_cache import configure_response_cache
+    from pyktok_local.rate_limit import rate_limiter
+
+    cache = configure_response_cache(path=os.path.join(work_dir, "pyktok_cache.db"), mode="on")
+    world.seed_cache(cache, args.videos_per_user)
+    set_url_rewriter(tiktok_rewriter(f"http://127.0.0.1:{tiktok_server.server_port}"))
+    if args.tiktok_rate is not None:
+        rate_limiter.configure("tiktok", args.tiktok_rate)
+
+    timer = StageTimer()
+    started = time.perf_counter()
+    outer_loop.run_crawl(world.video_url(world.roach_drop_id), fresh=True,
+                         max_cycles=args.cycles, observer=timer.observe)
+    wall_seconds = time.perf_counter() - started
+
+    # the roach drop itself runs outside the pipeline
+    videos_done = timer.completed("tag") + 1
+    extra = {
+        "tiktok requests": f"{tiktok_stand_in.requests} ({tiktok_stand_in.throttled} answered 429)",
+        "openai requests": f"{openai_stand_in.requests} ({openai_stand_in.throttled} answered 429)",
+        "page layouts": get_layout_counts(),
+        "rate limits": rate_limiter.stats(),
+    }
+    print_report(timer, wall_seconds, videos_done, extra)
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump({"args": vars(args), "wall_seconds": wall_seconds, "videos": videos_done,
+                       "videos_per_minute": videos_done / (wall_seconds / 60),
+                       "stages": timer.summary(), **{k: str(v) for k, v in extra.items()}}, f, indent=2)
+
+    tiktok_server.shutdown()
+    openai_server.shutdown()
+    if not args.keep:
+        os.chdir(repo_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
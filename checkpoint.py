@@ -0,0 +1,42 @@
+# checkpoint.py
+from crawl_state import CRAWL_STATE_DB, get_crawl_state_db
+
+# Per-url pipeline stages, in order
+DOWNLOADED, COMMENTS, TRANSCRIBED, TAGGED = "downloaded", "comments", "transcribed", "tagged"
+URL_STAGES = [DOWNLOADED, COMMENTS, TRANSCRIBED, TAGGED]
+
+class CrawlCheckpoint:
+    """Records which pipeline stages each url has completed, so a restarted
+    crawl can skip work (downloads, Whisper and LLM calls) it already paid for."""
+
+    def __init__(self, path: str = CRAWL_STATE_DB):
+        self.path = path
+        self._db, self._lock = get_crawl_state_db(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS url_stages (
+                url TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                PRIMARY KEY (url, stage)
+            );
+        """)
+        self._done = set(self._db.execute("SELECT url, stage FROM url_stages"))
+
+    def is_done(self, url: str, stage: str) -> bool:
+        with self._lock:
+            return (url, stage) in self._done
+
+    def mark_done(self, url: str, stage: str):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO url_stages VALUES (?, ?)", (url, stage))
+            self._done.add((url, stage))
+
+    def completed_stages(self, url: str) -> list:
+        """Stages this url has finished, in pipeline order."""
+        with self._lock:
+            return [stage for stage in URL_STAGES if (url, stage) in self._done]
+
+    def reset(self):
+        """Forget which stages every url finished, so they all rerun."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM url_stages")
+            self._done.clear()
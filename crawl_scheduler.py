@@ -0,0 +1,88 @@
+# crawl_scheduler.py
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# How many blocking calls of each kind may run at the same time
+DEFAULT_STAGE_LIMITS = {
+    "scrape": 4,  # listing a user's videos
+}
+
+class CrawlScheduler:
+    """Runs the per-user crawl work for many users on one event loop.
+
+    The blocking calls a user check makes before its videos go to the per-url
+    pipeline (listing the user's videos) are run on a bounded thread pool,
+    each within its stage's concurrency limit.
+
+    observer, if given, is called as observer(stage, seconds, error) after
+    every run_stage call (error is None on success).
+    """
+
+    def __init__(self, max_workers: int = 4, max_users: int = 4, stage_limits: dict = None,
+                 observer=None):
+        self.max_workers = max_workers
+        self.max_users = max_users
+        self.stage_limits = {**DEFAULT_STAGE_LIMITS, **(stage_limits or {})}
+        self.observer = observer
+        self._executor = None
+        self._semaphores = {}
+        self._loop = None
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix="roach")
+        # semaphores belong to an event loop; each roach cycle runs its own
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphores = {stage: asyncio.Semaphore(limit)
+                                for stage, limit in self.stage_limits.items()}
+
+    async def run_stage(self, stage: str, fn, *args, **kwargs):
+        """Run blocking `fn` on the worker pool, within `stage`'s concurrency limit."""
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        async with self._semaphores[stage]:
+            started = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(self._executor,
+                                                    functools.partial(fn, *args, **kwargs))
+            except Exception as e:
+                if self.observer is not None:
+                    self.observer(stage, time.perf_counter() - started, e)
+                raise
+            if self.observer is not None:
+                self.observer(stage, time.perf_counter() - started, None)
+            return result
+
+    async def crawl(self, usernames, check_user):
+        """Run `check_user(scheduler, username)` for every user.
+
+        Yields (username, result, error) tuples as soon as each user finishes,
+        so one slow user doesn't hold up reporting for the rest.
+        """
+        self._ensure_started()
+        user_slots = asyncio.Semaphore(self.max_users)
+
+        async def run_one(username):
+            async with user_slots:
+                try:
+                    return username, await check_user(self, username), None
+                except Exception as e:
+                    return username, None, e
+
+        tasks = [asyncio.create_task(run_one(username)) for username in usernames]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,19 @@
+# crawl_state.py
+import sqlite3
+import threading
+
+CRAWL_STATE_DB = "crawl_state.db"
+
+# path -> (connection, lock); the ledger, frontier and checkpoints all keep
+# their tables in the same file, so they share one connection and one lock
+crawl_state_dbs = {}
+crawl_state_dbs_lock = threading.Lock()
+
+def get_crawl_state_db(path: str = CRAWL_STATE_DB):
+    """Returns the shared (WAL-mode connection, RLock) pair for a crawl state file."""
+    with crawl_state_dbs_lock:
+        if path not in crawl_state_dbs:
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode = WAL")
+            crawl_state_dbs[path] = (db, threading.RLock())
+        return crawl_state_dbs[path]
@@ -0,0 +1,141 @@
+# frontier.py
+import heapq
+
+from crawl_state import CRAWL_STATE_DB, get_crawl_state_db
+
+# The roach drop's author is depth 0, its commenters depth 1, commenters on a
+# depth-1 user's bad videos depth 2, and so on
+DEFAULT_MAX_DEPTH = 2
+# Checks of one user that may error before the user is given up on
+MAX_ATTEMPTS = 3
+
+QUEUED, IN_PROGRESS, DONE, FAILED = "queued", "in_progress", "done", "failed"
+
+class CrawlFrontier:
+    """Persistent priority queue of users to check, most suspicious first.
+
+    Users are deduplicated (a user is crawled at most once), users deeper
+    than max_depth are never queued, and pop_batch() hands out at most a
+    per-cycle budget. State is kept in SQLite so a crawl can be resumed;
+    users that were handed out but never finished are re-queued on load.
+    A user whose check errors is re-queued until max_attempts, then failed.
+    """
+
+    def __init__(self, path: str = CRAWL_STATE_DB, max_depth: int = DEFAULT_MAX_DEPTH,
+                 max_attempts: int = MAX_ATTEMPTS):
+        self.path = path
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+        self._db, self._lock = get_crawl_state_db(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS frontier (
+                username TEXT PRIMARY KEY,
+                score REAL NOT NULL,
+                depth INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS frontier_status ON frontier(status);
+        """)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(frontier)")]
+        with self._db:
+            if "attempts" not in columns:  # state file from before failures were counted
+                self._db.execute("ALTER TABLE frontier ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("UPDATE frontier SET status = ? WHERE status = ?", (QUEUED, IN_PROGRESS))
+        # username -> [score, depth, status, attempts]
+        self.entries = {username: [score, depth, status, attempts]
+                        for username, score, depth, status, attempts
+                        in self._db.execute("SELECT username, score, depth, status, attempts FROM frontier")}
+        self._heap = [(-score, depth, username) for username, (score, depth, status, attempts)
+                      in self.entries.items() if status == QUEUED]
+        heapq.heapify(self._heap)
+
+    def _save(self, username: str):
+        score, depth, status, attempts = self.entries[username]
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO frontier (username, score, depth, status, attempts)"
+                             " VALUES (?, ?, ?, ?, ?)", (username, score, depth, status, attempts))
+
+    def add_root(self, username: str):
+        """Record a seed author (depth 0) that is already crawled."""
+        with self._lock:
+            self.entries[username] = [float("inf"), 0, DONE, 0]
+            self._save(username)
+
+    def depth_of(self, username: str) -> int:
+        """Crawl depth of a known user (seed authors not in the frontier count as 0)."""
+        entry = self.entries.get(username)
+        return entry[1] if entry else 0
+
+    def push(self, username: str, score: float, depth: int) -> bool:
+        """Queue a user, or re-prioritize one still queued. Returns whether anything changed."""
+        with self._lock:
+            entry = self.entries.get(username)
+            if entry is not None:
+                if entry[2] != QUEUED:
+                    return False  # already handed out or crawled
+                depth = min(depth, entry[1])
+                if entry[0] == score and entry[1] == depth:
+                    return False
+            if depth > self.max_depth:
+                return False
+            self.entries[username] = [score, depth, QUEUED, entry[3] if entry is not None else 0]
+            self._save(username)
+            heapq.heappush(self._heap, (-score, depth, username))
+            return True
+
+    def pop_batch(self, budget: int, skip=None) -> list:
+        """Hand out up to `budget` queued users as (username, score, depth), best first.
+
+        Users for which skip(username) is true are dropped from the frontier.
+        """
+        with self._lock:
+            batch = []
+            while self._heap and len(batch) < budget:
+                neg_score, depth, username = heapq.heappop(self._heap)
+                entry = self.entries.get(username)
+                if entry is None or entry[2] != QUEUED or entry[0] != -neg_score or entry[1] != depth:
+                    continue  # stale entry left behind by a later push
+                entry[2] = DONE if skip is not None and skip(username) else IN_PROGRESS
+                self._save(username)
+                if entry[2] == IN_PROGRESS:
+                    batch.append((username, -neg_score, depth))
+            return batch
+
+    def mark_done(self, username: str):
+        with self._lock:
+            if username in self.entries:
+                self.entries[username][2] = DONE
+                self._save(username)
+
+    def mark_failed(self, username: str) -> bool:
+        """Count a check of a handed-out user that errored. Re-queues the user, or
+        marks it failed once it has used up max_attempts; returns whether it will be retried."""
+        with self._lock:
+            entry = self.entries.get(username)
+            if entry is None or entry[2] != IN_PROGRESS:
+                return False
+            entry[3] += 1
+            entry[2] = QUEUED if entry[3] < self.max_attempts else FAILED
+            self._save(username)
+            if entry[2] == QUEUED:
+                heapq.heappush(self._heap, (-entry[0], entry[1], username))
+            return entry[2] == QUEUED
+
+    def has_queued(self) -> bool:
+        """Whether any user is still waiting to be handed out."""
+        with self._lock:
+            while self._heap:
+                neg_score, depth, username = self._heap[0]
+                entry = self.entries.get(username)
+                if entry is not None and entry[2] == QUEUED and entry[0] == -neg_score and entry[1] == depth:
+                    return True
+                heapq.heappop(self._heap)
+            return False
+
+    def reset(self):
+        """Empty the queue and forget who was crawled."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM frontier")
+            self.entries.clear()
+            self._heap.clear()
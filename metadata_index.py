@@ -0,0 +1,47 @@
+# metadata_index.py
+from collections import defaultdict
+
+class MetadataIndex:
+    """In-memory author index over one metadata collection.
+
+    Maps author username to the set of video urls, and is kept current one
+    record at a time via update().
+    """
+
+    def __init__(self, records: dict = None):
+        self._by_author = defaultdict(set)
+        self._authors = {}  # url -> author last indexed
+        for url, record in (records or {}).items():
+            self.update(url, record)
+
+    def _discard(self, author: str, url: str):
+        urls = self._by_author.get(author)
+        if urls is not None:
+            urls.discard(url)
+            if not urls:
+                del self._by_author[author]
+
+    def update(self, url: str, record: dict):
+        """(Re)index one record; only touched if its author changed."""
+        old_author = self._authors.get(url)
+        author = record.get("username")
+        if author != old_author:
+            if old_author is not None:
+                self._discard(old_author, url)
+            if author is not None:
+                self._by_author[author].add(url)
+        self._authors[url] = author
+
+    def remove(self, url: str):
+        self.update(url, {})
+        del self._authors[url]
+
+    def clear(self):
+        self._by_author.clear()
+        self._authors.clear()
+
+    def urls_by_author(self, username: str) -> set:
+        return set(self._by_author.get(username, ()))
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._authors
@@ -0,0 +1,74 @@
+# metadata_store.py
+import os
+import json
+import sqlite3
+import threading
+
+class SqliteMetadataStore:
+    """Video records grouped into named collections (e.g. "metadata", "bad_videos_metadata").
+
+    Kept in WAL-mode SQLite, one row per (collection, url), upserted in place.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS videos (
+                collection TEXT NOT NULL,
+                url TEXT NOT NULL,
+                username TEXT,
+                disinformation_found INTEGER,
+                data TEXT NOT NULL,
+                PRIMARY KEY (collection, url)
+            );
+            CREATE INDEX IF NOT EXISTS videos_url ON videos(url);
+            CREATE INDEX IF NOT EXISTS videos_username ON videos(collection, username);
+            CREATE INDEX IF NOT EXISTS videos_disinformation_found ON videos(collection, disinformation_found);
+        """)
+
+    def upsert(self, collection: str, url: str, record: dict):
+        disinformation_found = record.get("disinformation_found")
+        with self._lock, self._db:
+            self._db.execute("""
+                INSERT INTO videos (collection, url, username, disinformation_found, data)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(collection, url) DO UPDATE SET
+                    username = excluded.username,
+                    disinformation_found = excluded.disinformation_found,
+                    data = excluded.data""",
+                (collection, url, record.get("username"),
+                 None if disinformation_found is None else int(disinformation_found),
+                 json.dumps(record)))
+
+    def get(self, collection: str, url: str):
+        """Returns the record, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT data FROM videos WHERE collection = ? AND url = ?",
+                                   (collection, url)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def items(self, collection: str) -> dict:
+        """Returns {url: record} for the whole collection."""
+        with self._lock:
+            rows = self._db.execute("SELECT url, data FROM videos WHERE collection = ?",
+                                    (collection,)).fetchall()
+        return {url: json.loads(data) for url, data in rows}
+
+    def clear(self, collection: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM videos WHERE collection = ?", (collection,))
+
+    def export_json(self, collection: str, path: str):
+        """Writes a collection in the old {url: record} JSON file format."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.items(collection), f)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
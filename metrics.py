@@ -0,0 +1,124 @@
+# metrics.py
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Every timed call is appended here as one JSON object per line
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.jsonl")
+
+# counters of the innermost open span in this thread / task
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Metrics:
+    """Wall time and resource counters for every instrumented call.
+
+    Each call is written to a JSONL file as it finishes and folded into
+    per-name totals for the end-of-run summary table. Counters recorded
+    inside a span are also added to that span, so e.g. download_video's
+    record includes the bytes of the downloads it made.
+    """
+
+    def __init__(self, path: str = METRICS_FILE):
+        self.path = path
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, name: str, seconds: float, error=None, **counters):
+        """Log one finished call and add its counters to the enclosing span, if any."""
+        parent = _current_span.get()
+        if parent is not None:
+            for counter, value in counters.items():
+                parent[counter] = parent.get(counter, 0) + value
+        event = {"ts": time.time(), "name": name, "seconds": round(seconds, 6),
+                 "ok": error is None, **counters}
+        if error is not None:
+            event["error"] = f"{type(error).__name__}: {error}"
+        with self._lock:
+            totals = self.totals.setdefault(name, {"calls": 0, "errors": 0, "seconds": 0.0})
+            totals["calls"] += 1
+            totals["errors"] += error is not None
+            totals["seconds"] += seconds
+            for counter, value in counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+
+    def add(self, **counters):
+        """Add counters to the innermost open span (no-op outside one)."""
+        span_counters = _current_span.get()
+        if span_counters is not None:
+            for counter, value in counters.items():
+                span_counters[counter] = span_counters.get(counter, 0) + value
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the enclosed block and record it under name, with any counters added inside."""
+        counters = {}
+        token = _current_span.set(counters)
+        started = time.perf_counter()
+        error = None
+        try:
+            yield counters
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            self.record(name, time.perf_counter() - started, error, **counters)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {name: dict(totals) for name, totals in self.totals.items()}
+
+    def format_summary(self) -> str:
+        """The per-name totals as a fixed-width table."""
+        header = f"{'call':<28}{'calls':>7}{'errors':>7}{'total s':>10}{'mean s':>9}" \
+                 f"{'MB':>9}{'audio s':>9}{'prompt tok':>12}{'compl tok':>11}"
+        lines = [header, "-" * len(header)]
+        for name, totals in sorted(self.summary().items()):
+            lines.append(f"{name:<28}{totals['calls']:>7}{totals['errors']:>7}"
+                         f"{totals['seconds']:>10.2f}{totals['seconds'] / totals['calls']:>9.3f}"
+                         f"{totals.get('bytes', 0) / 1e6:>9.2f}{totals.get('audio_seconds', 0):>9.1f}"
+                         f"{totals.get('prompt_tokens', 0):>12}{totals.get('completion_tokens', 0):>11}")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+metrics = None
+metrics_lock = threading.Lock()
+def get_metrics():
+    global metrics
+    with metrics_lock:
+        if metrics == None:
+            metrics = Metrics()
+        return metrics
+
+def timed(name: str = None):
+    """Decorator: record every call of the function (or coroutine function) as a span,
+    named after it by default."""
+    def decorate(fn):
+        span_name = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with get_metrics().span(span_name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_metrics().span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,94 @@
+# narrative_classifier.py
+import re
+import zlib
+import numpy as np
+
+# Hashed feature space; 2**14 keeps the 25 x F narrative matrix around 1.6 MB
+N_FEATURES = 2 ** 14
+# Transcripts are scored in overlapping windows of this many words, so one
+# on-narrative sentence in a long video isn't drowned out by the rest
+WINDOW_WORDS = 40
+WINDOW_STRIDE = 20
+DEFAULT_THRESHOLD = 0.12
+DEFAULT_TOP_K = 5
+
+STOPWORDS = set("""
+a about above after again against all am an and any are as at be because been before being
+below between both but by can could did do does doing down during each few for from further
+had has have having he her here hers herself him himself his how i if in into is it its itself
+just me more most my myself no nor not now of off on once only or other our ours ourselves out
+over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which
+while who whom why will with would you your yours yourself yourselves
+""".split())
+
+narrative_line_regex = re.compile(r"^\s*(\d+)\.\s*(.+?)\s*$", re.MULTILINE)
+word_regex = re.compile(r"[a-z0-9']+")
+
+def parse_narratives(narratives_text: str) -> dict:
+    """Turns a numbered narrative list ("1. ...\\n2. ...") into {number: text}."""
+    return {int(number): text for number, text in narrative_line_regex.findall(narratives_text)}
+
+def tokenize(text: str) -> list:
+    """Lowercased content words; a crude suffix strip lets plurals match singulars."""
+    words = [w.strip("'") for w in word_regex.findall(text.lower())]
+    return [w[:-1] if len(w) > 3 and w.endswith("s") else w
+            for w in words if w and w not in STOPWORDS]
+
+def _feature_ids(words: list) -> list:
+    # unigrams + bigrams, hashed with crc32 so vectors are stable across runs
+    terms = words + [a + " " + b for a, b in zip(words, words[1:])]
+    return [zlib.crc32(term.encode()) % N_FEATURES for term in terms]
+
+def _hash_vectors(docs: list) -> np.ndarray:
+    """Sublinear-tf hashed term matrix, one row per list of words."""
+    matrix = np.zeros((len(docs), N_FEATURES), dtype=np.float32)
+    for row, words in enumerate(docs):
+        ids = _feature_ids(words)
+        if ids:
+            np.add.at(matrix[row], ids, 1.0)
+    np.log1p(matrix, out=matrix)
+    return matrix
+
+def _l2_normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+class NarrativeClassifier:
+    """Offline TF-IDF (feature-hashed) similarity between transcripts and known narratives.
+
+    Narrative vectors are computed once at construction. score() is a single
+    matrix product of transcript windows against all narratives.
+    """
+
+    def __init__(self, narratives_text: str, threshold: float = DEFAULT_THRESHOLD, top_k: int = DEFAULT_TOP_K):
+        self.threshold = threshold
+        self.top_k = top_k
+        narratives = parse_narratives(narratives_text)
+        self.numbers = np.array(list(narratives.keys()))
+        tf = _hash_vectors([tokenize(text) for text in narratives.values()])
+        # idf over the narrative set, so words shared by many narratives
+        # ("ukraine", "russia") count for less than distinctive ones
+        df = np.count_nonzero(tf, axis=0)
+        self.idf = (np.log((1 + len(narratives)) / (1 + df)) + 1).astype(np.float32)
+        self.narrative_vectors = _l2_normalize(tf * self.idf)
+
+    def _window_vectors(self, text: str) -> np.ndarray:
+        words = tokenize(text)
+        starts = range(0, max(len(words) - WINDOW_WORDS, 0) + 1, WINDOW_STRIDE)
+        windows = [words[i:i + WINDOW_WORDS] for i in starts]
+        if len(words) > WINDOW_WORDS and (len(words) - WINDOW_WORDS) % WINDOW_STRIDE:
+            windows.append(words[-WINDOW_WORDS:])
+        return _l2_normalize(_hash_vectors(windows) * self.idf)
+
+    def similarities(self, text: str) -> np.ndarray:
+        """Cosine similarity of the best-matching window to each narrative."""
+        return (self._window_vectors(text) @ self.narrative_vectors.T).max(axis=0)
+
+    def score(self, text: str):
+        """Returns (best score, candidate narrative numbers above threshold, best first)."""
+        sims = self.similarities(text)
+        order = np.argsort(-sims)[:self.top_k]
+        candidates = [int(self.numbers[i]) for i in order if sims[i] >= self.threshold]
+        return float(sims.max()) if len(sims) else 0.0, candidates
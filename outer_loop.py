@@ -1,7 +1,16 @@
-from utils import download_video, extract_comments, transcribe_mp4, DATA_DIR, METADATA_FILE, get_video_urls_from_user, write_metadata, tag_narratives, transfer_metadata
+from utils import download_video, extract_comments, transcribe_mp4, prepare_audio, transcribe_audio_async, has_local_video, remove_local_video, tag_narratives_batch_async, close_async_openai_client, MAX_BATCH_SIZE, DATA_DIR, METADATA_FILE, BAD_VIDEOS_FILE, get_video_urls_from_user, write_metadata, tag_narratives, transfer_metadata, get_metadata, get_collection, clear_metadata, export_metadata, clean_url
 
-import json
-import math
+from crawl_scheduler import CrawlScheduler
+from suspicion import SuspicionLedger
+from frontier import CrawlFrontier
+from checkpoint import CrawlCheckpoint, DOWNLOADED, COMMENTS, TRANSCRIBED, TAGGED
+from pipeline import Pipeline, Stage, Batcher
+from audio import AUDIO_WORKERS
+from metrics import get_metrics
+
+import argparse
+import asyncio
+import functools
 import os
 
 from dotenv import load_dotenv
@@ -9,93 +18,230 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
-def get_10_comments():
-    global checked_clean_users
-    with open('bad_videos_metadata.json', 'r') as f:
-        bad_video_data = json.load(f)
-
-    bad_video_authors = set([video_data['username']
-                            for video_data in bad_video_data.values()])
-    MAX_CHECK_COMMENTERS_PER_VIDEO = 20
-
-    user_suspicions = {}
-    for video_url, video_data in bad_video_data.items():
-        for comment in video_data['comments'][:MAX_CHECK_COMMENTERS_PER_VIDEO]:
-            username = comment['username']
-            if (username in checked_clean_users) or (username in bad_video_authors):
-                continue  # We already checked this user
-            if username not in user_suspicions:
-                user_suspicions[username] = 0  # Initialize suspicion score
-            user_suspicions[username] += 10  # We saw this user commenting
-            if comment['is_top_list_marked']:
-                user_suspicions[username] += 5
-            if comment['is_liked_by_author']:
-                user_suspicions[username] += 10
-            if comment['likes'] > 0:
-                user_suspicions[username] += math.log(comment['likes'], 2) + 1
-
-    # Get the 10 most suspicious users by sorting the suspicion scores
-    most_suspicious_users = sorted(
-        user_suspicions.items(), key=lambda x: x[1], reverse=True)[:10]
-    print("\nTop 10 most suspicious users:")
-    for username, suspicion_score in most_suspicious_users:
-        print(f"{username}: {suspicion_score:.1f}")
-    return list(user_suspicions.keys())
-
-
-def check_user(username):
-    urls = get_video_urls_from_user(username, n=1)
+# Crawl expansion: how many hops out from the roach drop, how many users to
+# check per cycle, and how many cycles to run
+MAX_DEPTH = 2
+CYCLE_BUDGET = 10
+MAX_CYCLES = 5
+
+
+def expand_frontier(url, video_metadata):
+    """Score a newly flagged video's commenters and queue them one hop deeper."""
+    updated_scores = ledger.apply_video(url, video_metadata)
+    depth = frontier.depth_of(video_metadata.get("username")) + 1
+    for username, suspicion_score in updated_scores.items():
+        if not ledger.is_excluded(username):
+            frontier.push(username, suspicion_score, depth)
+
+
+def get_suspicious_users(budget=CYCLE_BUDGET):
+    # Highest-scoring unchecked users first, at most `budget` of them
+    most_suspicious_users = frontier.pop_batch(budget, skip=ledger.is_excluded)
+    print(f"\nTop {len(most_suspicious_users)} most suspicious users:")
+    for username, suspicion_score, depth in most_suspicious_users:
+        print(f"{username}: {suspicion_score:.1f} (depth {depth})")
+    return [username for username, _, _ in most_suspicious_users]
+
+
+# Crawl concurrency: users in flight and worker threads for listing their
+# videos, then worker counts and queue size for the per-url pipeline stages
+MAX_USERS_IN_FLIGHT = 4
+STAGE_LIMITS = {"scrape": 4}
+MAX_WORKERS = STAGE_LIMITS["scrape"]  # scrape is the only stage on the thread pool
+# extract_audio workers mostly wait on ffmpeg, capped at AUDIO_WORKERS processes.
+# transcribe and tag run on the async OpenAI client: their workers are
+# coroutines (no threads), bounded overall by OPENAI_MAX_IN_FLIGHT. tag
+# workers only wait on the tag batcher, so a full batch can be in flight
+STAGE_WORKERS = {"download": 4, "comments": 4, "extract_audio": AUDIO_WORKERS, "transcribe": 8,
+                 "tag": MAX_BATCH_SIZE}
+PIPELINE_QUEUE_SIZE = 4
+# Videos reaching the tag stage within this many seconds of each other are
+# tagged together, in as few LLM requests as their transcripts fit
+TAG_BATCH_WAIT = 2.0
+# Called as stage_observer(stage, seconds, error) after every scrape and
+# pipeline stage call, e.g. by benchmark.py to collect stage latencies
+stage_observer = None
+
+
+def run_checkpointed(url, stage, fn):
+    """Run fn(url) unless a previous run already finished this stage for url."""
+    if not checkpoint.is_done(url, stage):
+        fn(url)
+        checkpoint.mark_done(url, stage)
+
+
+def download_stage(url):
+    # the video is only deleted once its transcript is stored, but a crawl
+    # state from before that may have a downloaded url with no file left
+    if (checkpoint.is_done(url, DOWNLOADED) and not checkpoint.is_done(url, TRANSCRIBED)
+            and not has_local_video(url)):
+        download_video(url)
+    run_checkpointed(url, DOWNLOADED, download_video)
+
+
+def extract_audio_stage(url):
+    if checkpoint.is_done(url, TRANSCRIBED):
+        return None
+    audio = prepare_audio(url)
+    if audio is False:
+        raise RuntimeError(f"No downloaded video for {url}")
+    return audio
+
+
+async def transcribe_stage(url, audio):
+    # audio is None when the transcript was already cached or done
+    if audio is not None:
+        await transcribe_audio_async(url, audio)
+    checkpoint.mark_done(url, TRANSCRIBED)
+    remove_local_video(url)
+
+
+async def tag_stage(url):
+    if not checkpoint.is_done(url, TAGGED):
+        await tag_batcher.submit(url)
+        checkpoint.mark_done(url, TAGGED)
+    return get_metadata(url)["narratives"]
+
+
+def build_pipeline():
+    return Pipeline([
+        Stage("download", download_stage, workers=STAGE_WORKERS["download"]),
+        Stage("comments", functools.partial(run_checkpointed, stage=COMMENTS, fn=extract_comments),
+              workers=STAGE_WORKERS["comments"]),
+        Stage("extract_audio", extract_audio_stage, workers=STAGE_WORKERS["extract_audio"]),
+        Stage("transcribe", transcribe_stage, workers=STAGE_WORKERS["transcribe"], takes_result=True),
+        Stage("tag", tag_stage, workers=STAGE_WORKERS["tag"]),
+    ], queue_size=PIPELINE_QUEUE_SIZE, observer=stage_observer)
+
+
+async def check_url(url):
+    narratives = await pipeline.submit(clean_url(url))
+    if len(narratives) > 0:
+        transfer_metadata(url, BAD_VIDEOS_FILE)
+        video_metadata = get_metadata(url)
+        expand_frontier(video_metadata["url"], video_metadata)
+    return narratives
+
+
+async def check_user(scheduler, username):
+    urls = await scheduler.run_stage("scrape", get_video_urls_from_user, username, n=1)
     print(f"for suspicious user {username}: {urls}")
-    
+
     all_narratives = []
-    for url in urls:
-        try:
-            download_video(url)
-            extract_comments(url)
-            transcribe_mp4(url)
-            narratives = tag_narratives(url)
-            write_metadata()
-            all_narratives.extend(narratives)
-            if len(narratives) > 0:
-                transfer_metadata(url, 'bad_videos_metadata.json')
-        except Exception as e:
-            print(f"Error processing {url}: {e}")
+    errors = []
+    results = await asyncio.gather(*[check_url(url) for url in urls],
+                                   return_exceptions=True)
+    for url, narratives in zip(urls, results):
+        if isinstance(narratives, Exception):
+            print(f"Error processing {url}: {narratives}")
+            errors.append(narratives)
             continue
+        all_narratives.extend(narratives)
+    if errors and not all_narratives:
+        # nothing found, but not every video was checked: the user isn't clean
+        raise RuntimeError(f"{len(errors)} of {len(urls)} videos by {username} failed") from errors[0]
     return all_narratives
 
 
-if __name__ == "__main__":
-    # roach drop site
-    roach_drop = 'https://www.tiktok.com/@jeffrey1012/video/7298550647857728786?q=ukraine%20war%20corruption&t=1731700011325'
-    #roach_drop = 'https://www.tiktok.com/@tulsigabbard/video/7299018744955800874?q=zelensky%20is%20corrupt&t=1731711530705'
-    # Clean up data directory
+async def check_users(scheduler, suspicious_users):
+    global pipeline, tag_batcher
+    pipeline = build_pipeline()
+    tag_batcher = Batcher(tag_narratives_batch_async, max_size=MAX_BATCH_SIZE, max_wait=TAG_BATCH_WAIT)
+    await pipeline.start()
+    try:
+        await _check_users(scheduler, suspicious_users)
+    finally:
+        await pipeline.close()
+        await tag_batcher.close()
+        await close_async_openai_client()
+
+
+async def _check_users(scheduler, suspicious_users):
+    async for suspicious_user, found_narratives, error in scheduler.crawl(suspicious_users, check_user):
+        if error is not None:
+            if frontier.mark_failed(suspicious_user):
+                print(f"Error checking user {suspicious_user}, will retry: {error}")
+            else:
+                print(f"Error checking user {suspicious_user}, giving up: {error}")
+            continue
+        frontier.mark_done(suspicious_user)
+        if len(found_narratives) == 0:
+            ledger.mark_clean(suspicious_user)
+            print(f"User {suspicious_user} is clean")
+        else:
+            ledger.mark_bad(suspicious_user)
+            print(f"User {suspicious_user} is bad")
+
+
+ROACH_DROP = 'https://www.tiktok.com/@jeffrey1012/video/7298550647857728786?q=ukraine%20war%20corruption&t=1731700011325'
+#ROACH_DROP = 'https://www.tiktok.com/@tulsigabbard/video/7299018744955800874?q=zelensky%20is%20corrupt&t=1731711530705'
+
+
+def run_crawl(roach_drop, fresh=False, max_cycles=MAX_CYCLES, observer=None):
+    """Crawl outward from the roach drop video for up to max_cycles cycles.
+
+    Resumes from the saved crawl state unless fresh is set. observer is
+    installed as stage_observer for the duration of the crawl.
+    """
+    global ledger, frontier, checkpoint, stage_observer
+    stage_observer = observer
     os.makedirs(DATA_DIR, exist_ok=True)
-    for file in os.listdir(DATA_DIR):
-        file_path = os.path.join(DATA_DIR, file)
-        try:
-            if os.path.isfile(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(f"Error deleting {file_path}: {e}")
-    if os.path.exists('bad_videos_metadata.json'): os.remove('bad_videos_metadata.json')
-    with open('metadata.json', 'w') as f: json.dump({}, f)
-
-    download_video(roach_drop)
-    extract_comments(roach_drop)
-    transcribe_mp4(roach_drop)
-    tag_narratives(roach_drop)
-    write_metadata()
-    os.rename('metadata.json', 'bad_videos_metadata.json')
-
-    checked_clean_users = []
-    for roach_cycle_i in range(1):
-        with open('metadata.json', 'w') as f: json.dump({}, f)
-        suspicious_users = get_10_comments()
+    ledger = SuspicionLedger()
+    frontier = CrawlFrontier(max_depth=MAX_DEPTH)
+    checkpoint = CrawlCheckpoint()
+    if fresh:
+        # Clean up data directory
+        for file in os.listdir(DATA_DIR):
+            file_path = os.path.join(DATA_DIR, file)
+            try:
+                if os.path.isfile(file_path):
+                    os.unlink(file_path)
+            except Exception as e:
+                print(f"Error deleting {file_path}: {e}")
+        clear_metadata(BAD_VIDEOS_FILE)
+        clear_metadata(METADATA_FILE)
+        ledger.reset()
+        frontier.reset()
+        checkpoint.reset()
+
+    roach_drop = clean_url(roach_drop)
+    download_stage(roach_drop)
+    run_checkpointed(roach_drop, COMMENTS, extract_comments)
+    run_checkpointed(roach_drop, TRANSCRIBED, transcribe_mp4)
+    run_checkpointed(roach_drop, TAGGED, tag_narratives)
+    transfer_metadata(roach_drop, BAD_VIDEOS_FILE)
+    export_metadata(BAD_VIDEOS_FILE)
+    # also picks up bad videos whose scoring a crash interrupted
+    bad_video_data = get_collection(BAD_VIDEOS_FILE)
+    frontier.add_root(bad_video_data[roach_drop]["username"])
+    for url, video_metadata in bad_video_data.items():
+        expand_frontier(url, video_metadata)
+
+    scheduler = CrawlScheduler(max_workers=MAX_WORKERS,
+                               max_users=MAX_USERS_IN_FLIGHT,
+                               stage_limits=STAGE_LIMITS,
+                               observer=observer)
+    for roach_cycle_i in range(max_cycles):
+        if not frontier.has_queued():
+            print("Frontier is empty, stopping")
+            break
+        suspicious_users = get_suspicious_users()
         print(suspicious_users)
-        for suspicious_user in suspicious_users:
-            found_narratives = check_user(suspicious_user)
-            if len(found_narratives) == 0: 
-                checked_clean_users.append(suspicious_user)
-                print(f"User {suspicious_user} is clean")
-            else:
-                print(f"User {suspicious_user} is bad")
+        asyncio.run(check_users(scheduler, suspicious_users))
+        # JSON copies for anything that still reads the old files
+        write_metadata()
+        export_metadata(BAD_VIDEOS_FILE)
+    scheduler.shutdown()
+    # per-call detail is in the metrics JSONL file
+    print(get_metrics().format_summary())
+    get_metrics().close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl outward from a roach drop video.")
+    parser.add_argument("--fresh", action="store_true",
+                        help="discard downloads and all saved crawl state and start over "
+                             "(default: resume where the last run stopped)")
+    args = parser.parse_args()
+
+    run_crawl(ROACH_DROP, fresh=args.fresh)
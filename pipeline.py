@@ -0,0 +1,171 @@
+# pipeline.py
+import asyncio
+import inspect
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# How many finished items may wait in front of each stage. Once a queue is
+# full, the stage feeding it blocks, so e.g. downloads can't pile videos up on
+# disk while transcription is behind.
+DEFAULT_QUEUE_SIZE = 4
+
+class Stage:
+    """One pipeline step: a handler plus how many workers run it.
+
+    The handler is called as handler(item), or handler(item, result) with the
+    previous stage's return value if takes_result is set. Blocking handlers
+    run on the pipeline's thread pool; coroutine functions are awaited on the
+    event loop, so their workers cost no threads.
+    """
+
+    def __init__(self, name: str, handler, workers: int = 1, takes_result: bool = False):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.takes_result = takes_result
+
+class Pipeline:
+    """Runs items through a fixed sequence of stages, with a bounded queue in
+    front of each stage and each stage's workers running independently.
+
+    observer, if given, is called as observer(stage_name, seconds, error)
+    after every handler call (error is None on success).
+    """
+
+    def __init__(self, stages: list, queue_size: int = DEFAULT_QUEUE_SIZE, observer=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.observer = observer
+        self._queues = []
+        self._workers = []
+        self._executor = None
+
+    async def start(self):
+        blocking_workers = sum(stage.workers for stage in self.stages
+                               if not inspect.iscoroutinefunction(stage.handler))
+        self._executor = ThreadPoolExecutor(max_workers=max(blocking_workers, 1),
+                                            thread_name_prefix="roach-pipeline")
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        self._workers = [asyncio.create_task(self._work(i))
+                         for i, stage in enumerate(self.stages)
+                         for _ in range(stage.workers)]
+
+    async def _work(self, stage_i: int):
+        stage = self.stages[stage_i]
+        queue = self._queues[stage_i]
+        loop = asyncio.get_running_loop()
+        while True:
+            item, result, future = await queue.get()
+            try:
+                if future.done():
+                    continue  # the submitter went away
+                args = (result,) if stage.takes_result else ()
+                started = time.perf_counter()
+                try:
+                    if inspect.iscoroutinefunction(stage.handler):
+                        result = await stage.handler(item, *args)
+                    else:
+                        result = await loop.run_in_executor(
+                            self._executor, functools.partial(stage.handler, item, *args))
+                except Exception as e:
+                    self._observe(stage, started, e)
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                self._observe(stage, started, None)
+                if stage_i + 1 < len(self.stages):
+                    # blocks while the next stage is backed up
+                    await self._queues[stage_i + 1].put((item, result, future))
+                elif not future.done():
+                    future.set_result(result)
+            finally:
+                queue.task_done()
+
+    def _observe(self, stage: Stage, started: float, error):
+        if self.observer is not None:
+            self.observer(stage.name, time.perf_counter() - started, error)
+
+    async def submit(self, item):
+        """Send an item through every stage; returns the last stage's result."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queues[0].put((item, None, future))
+        return await future
+
+    def queue_depths(self) -> dict:
+        """How many items are waiting in front of each stage."""
+        return {stage.name: queue.qsize() for stage, queue in zip(self.stages, self._queues)}
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+class Batcher:
+    """Groups items submitted by concurrent tasks into one handler call.
+
+    A batch is sent once it holds max_size items, or max_wait seconds after
+    its first item arrived, whichever comes first. The handler is a
+    coroutine function awaited as handler(items) that returns
+    {item: result}; each submitter gets its own item's result (or the
+    batch's exception).
+    """
+
+    def __init__(self, handler, max_size: int, max_wait: float):
+        self.handler = handler
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending = []  # (item, future)
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list):
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for item, future in batch:
+            if future.done():
+                continue
+            if item in results:
+                future.set_result(results[item])
+            else:
+                # a handler that skipped an item mustn't leave its submitter waiting forever
+                future.set_exception(KeyError(f"batch handler returned no result for {item!r}"))
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for TikTok page JSON, comment lists and user video lists, plus
+the size of every finished video download.
+
+Entries live in SQLite with a per-endpoint TTL and are evicted least recently
+used once the cache passes its size cap. Stale page entries that came with an
+ETag / Last-Modified are revalidated with a conditional request rather than
+refetched. Modes: 'on' (default), 'off', and 'replay', which never touches the
+network and raises CacheMissError for anything not cached.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from sqlite_lru import SizeCap
+
+# endpoint: seconds an entry is served without going back to TikTok. A video
+# page carries its current stats and signed CDN video urls that expire, so it
+# is only kept briefly; comment and user video lists grow more slowly.
+default_ttls = {'page': 15 * 60,
+                'comments': 3600,
+                'user_videos': 3600,
+                # only read in replay mode, which ignores TTLs
+                'download': 0}
+
+cache_modes = ['on','off','replay']
+cache_mode = os.environ.get(
+    "pyktok_cache_mode", "on"
+)
+cache_path = os.environ.get(
+    "pyktok_cache_path", "pyktok_cache.db"
+)
+cache_max_bytes = int(os.environ.get(
+    "pyktok_cache_max_mb", 256
+)) * 1024 * 1024
+
+class CacheMissError(Exception):
+    def __init__(self,endpoint,key):
+        super().__init__('Replay mode: nothing cached for ' + endpoint + ' ' + key)
+        self.endpoint = endpoint
+        self.key = key
+
+class ResponseCache:
+    def __init__(self,path=cache_path,max_bytes=cache_max_bytes,ttls=None,mode=cache_mode):
+        if mode not in cache_modes:
+            raise ValueError('cache mode must be one of ' + ', '.join(cache_modes))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(default_ttls if ttls is None else ttls)
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path,check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                expires_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (endpoint, key)
+            );
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+        ''')
+        self._size_cap = SizeCap(self._db,'responses',['endpoint','key'],max_bytes)
+
+    def lookup(self,endpoint,key):
+        # returns (value, fresh, validators) or None; replay mode treats every
+        # entry as fresh and raises on a miss
+        if self.mode == 'off':
+            return None
+        with self._lock, self._db:
+            row = self._db.execute('SELECT value, etag, last_modified, expires_at FROM responses '
+                                   'WHERE endpoint = ? AND key = ?',(endpoint,key)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == 'replay':
+                    raise CacheMissError(endpoint,key)
+                return None
+            value, etag, last_modified, expires_at = row
+            fresh = self.mode == 'replay' or expires_at > time.time()
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._db.execute('UPDATE responses SET last_used = ? WHERE endpoint = ? AND key = ?',
+                             (time.time(),endpoint,key))
+            return json.loads(value), fresh, {'etag': etag, 'last_modified': last_modified}
+
+    def get(self,endpoint,key):
+        # the cached value if it is still fresh, else None
+        entry = self.lookup(endpoint,key)
+        if entry is None or not entry[1]:
+            return None
+        return entry[0]
+
+    def put(self,endpoint,key,value,etag=None,last_modified=None):
+        if self.mode != 'on':
+            return
+        serialized = json.dumps(value)
+        size = len(serialized.encode())
+        now = time.time()
+        with self._lock, self._db:
+            old_size = self._size_cap.size_of((endpoint,key))
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (endpoint,key,serialized,etag,last_modified,
+                              now + self.ttls.get(endpoint,0),size,now))
+            self._size_cap.replaced(old_size,size)
+
+    def refresh(self,endpoint,key):
+        # a conditional request came back 304: the entry is good for another TTL
+        with self._lock, self._db:
+            self.revalidated += 1
+            self._db.execute('UPDATE responses SET expires_at = ? WHERE endpoint = ? AND key = ?',
+                             (time.time() + self.ttls.get(endpoint,0),endpoint,key))
+
+    def invalidate(self,endpoint,key):
+        # drop one entry, e.g. a page whose CDN urls turned out to be expired
+        if self.mode != 'on':
+            return
+        with self._lock, self._db:
+            old_size = self._size_cap.size_of((endpoint,key))
+            self._db.execute('DELETE FROM responses WHERE endpoint = ? AND key = ?',(endpoint,key))
+            self._size_cap.total -= old_size
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+            self._size_cap.cleared()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'mode': self.mode,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'revalidated': self.revalidated,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+def configure_response_cache(path=cache_path,max_bytes=cache_max_bytes,ttls=None,mode=cache_mode):
+    global response_cache
+    with response_cache_lock:
+        response_cache = ResponseCache(path,max_bytes,ttls,mode)
+        return response_cache
+
+def get_response_cache():
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache()
+        return response_cache
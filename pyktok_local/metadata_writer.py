@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only metadata CSV writer.
+
+Rows are appended to the CSV (the header is written once, when the file is
+created) and the dedup key of every row written is kept in a small SQLite
+sidecar next to it, so writing a row never means re-reading the file.
+"""
+
+import csv
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+sidecar_suffix = '.seen.db'
+
+class MetadataWriter:
+    def __init__(self,metadata_fn,dedup_field=None):
+        self.metadata_fn = metadata_fn
+        self.dedup_field = dedup_field
+        self.index_fn = metadata_fn + sidecar_suffix
+        self.header = None
+        self._lock = threading.Lock()
+        self._db = None
+        if dedup_field is not None:
+            self._db = sqlite3.connect(self.index_fn,check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)')
+            self._sync_index()
+
+    def _sync_index(self):
+        # the sidecar only describes the CSV next to it: drop it if the CSV is
+        # gone, and build it (once) from the key column of a CSV written before
+        # the sidecar existed
+        with self._db:
+            if not os.path.exists(self.metadata_fn) or os.path.getsize(self.metadata_fn) == 0:
+                self._db.execute('DELETE FROM seen')
+                self.header = None
+            elif self._db.execute('SELECT 1 FROM seen LIMIT 1').fetchone() is None:
+                header = self._read_header()
+                if header is not None and self.dedup_field in header:
+                    keys = pd.read_csv(self.metadata_fn,usecols=[self.dedup_field],
+                                       dtype=str,keep_default_na=False)[self.dedup_field]
+                    self._db.executemany('INSERT OR IGNORE INTO seen VALUES (?)',
+                                         ((k,) for k in keys))
+
+    def _read_header(self):
+        if not os.path.exists(self.metadata_fn) or os.path.getsize(self.metadata_fn) == 0:
+            return None
+        with open(self.metadata_fn,newline='',encoding='utf-8') as f:
+            return next(csv.reader(f),None)
+
+    def _is_seen(self,key):
+        return self._db.execute('SELECT 1 FROM seen WHERE key = ?',(key,)).fetchone() is not None
+
+    def _unseen(self,data_rows):
+        if self.dedup_field is None or len(data_rows) == 0:
+            return data_rows
+        if not os.path.exists(self.metadata_fn):
+            self._sync_index()
+        keys = data_rows[self.dedup_field].astype(str)
+        data_rows = data_rows[[not self._is_seen(k) for k in keys]]
+        return data_rows[~data_rows[self.dedup_field].astype(str).duplicated()]
+
+    def unseen(self,data_rows):
+        # rows whose key is neither in the file already nor earlier in data_rows
+        with self._lock:
+            return self._unseen(data_rows)
+
+    def append(self,data_rows):
+        # returns the number of rows actually written
+        with self._lock:
+            data_rows = self._unseen(data_rows)
+            if len(data_rows) == 0:
+                return 0
+            if self.header is None or not os.path.exists(self.metadata_fn):
+                self.header = self._read_header()
+            if self.header is None:
+                self.header = list(data_rows.columns)
+                write_header = True
+            else:
+                # keep the file's column order; columns it doesn't have are dropped
+                data_rows = data_rows.reindex(columns=self.header)
+                write_header = False
+            with open(self.metadata_fn,'a',newline='',encoding='utf-8') as f:
+                data_rows.to_csv(f,header=write_header,index=False)
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany('INSERT OR IGNORE INTO seen VALUES (?)',
+                                         ((k,) for k in data_rows[self.dedup_field].astype(str)))
+            return len(data_rows)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+writers = {}
+writers_lock = threading.Lock()
+
+def get_metadata_writer(metadata_fn,dedup_field=None):
+    # one writer per file, shared by every thread appending to it
+    key = os.path.abspath(metadata_fn)
+    with writers_lock:
+        if key not in writers or writers[key].dedup_field != dedup_field:
+            if key in writers:
+                writers[key].close()
+            writers[key] = MetadataWriter(metadata_fn,dedup_field)
+        return writers[key]
+
+def release_metadata_writer(metadata_fn):
+    # close a file's writer once nothing is appending to it any more
+    with writers_lock:
+        writer = writers.pop(os.path.abspath(metadata_fn),None)
+    if writer is not None:
+        writer.close()
+
+def remove_metadata_file(metadata_fn):
+    # delete a metadata CSV along with its writer and sidecar index
+    release_metadata_writer(metadata_fn)
+    for fn in [metadata_fn,metadata_fn + sidecar_suffix]:
+        if os.path.exists(fn):
+            os.remove(fn)
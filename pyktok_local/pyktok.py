@@ -6,18 +6,28 @@ Created on Thu Jul 14 14:06:01 2022
 """
 
 import asyncio
+import atexit
 import browser_cookie3
-from bs4 import BeautifulSoup
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from http.cookiejar import DefaultCookiePolicy
 import json
 import numpy as np
 import os
 import pandas as pd
-import random
 import re
 import requests
+from requests.adapters import HTTPAdapter
 from TikTokApi import TikTokApi
+import threading
 import time
+from urllib3.util.retry import Retry
+
+from .http_cache import CacheMissError, get_response_cache
+from .metadata_writer import get_metadata_writer, release_metadata_writer
+from .rate_limit import rate_limiter
 
 global cookies
 cookies = dict()
@@ -28,6 +38,12 @@ video_id_regex = '(?<=/video/)([0-9]+)'
 ms_token = os.environ.get(
     "ms_token", None
 )
+tiktok_sessions = int(os.environ.get(
+    "tiktok_sessions", 3
+))
+http_pool_size = int(os.environ.get(
+    "http_pool_size", 16
+))
 
 headers = {'Accept-Encoding': 'gzip, deflate, sdch',
            'Accept-Language': 'en-US,en;q=0.8',
@@ -49,141 +65,165 @@ class BrowserNotSpecifiedError(Exception):
     def __init__(self):
         super().__init__(runsb_err)
 
+# one keep-alive, connection-pooled HTTP session shared by every page fetch and
+# CDN download (and safe to share between worker threads)
+
+global http_session
+http_session = None
+http_session_lock = threading.Lock()
+
+def configure_http_session(pool_size=http_pool_size,
+                           retries=3,
+                           backoff_factor=0.5):
+    global http_session
+    # only 5xx is retried here. 429s are left to http_get so the shared rate
+    # limiter can slow down: with respect_retry_after_header on, urllib3 would
+    # itself retry any 429 carrying Retry-After, even one not in status_forcelist
+    retry = Retry(total=retries,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=[500,502,503,504],
+                  allowed_methods=['GET','HEAD'],
+                  respect_retry_after_header=False,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://',adapter)
+    session.mount('http://',adapter)
+    # the session must not keep its own cookies: callers pass the module-level
+    # `cookies` jar explicitly, exactly as with bare requests.get
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    with http_session_lock:
+        http_session = session
+    return session
+
+def get_http_session():
+    with http_session_lock:
+        session = http_session
+    if session is None:
+        session = configure_http_session()
+    return session
+
+# optional fn(url) -> url applied to every request just before it is sent,
+# e.g. to point TikTok hosts at a local stand-in server for benchmarking.
+# Rate limiting and caching still key on the original url.
+url_rewriter = None
+
+def set_url_rewriter(fn):
+    global url_rewriter
+    url_rewriter = fn
+
+# optional fn(name, seconds, error, **counters) called after every page
+# fetch, download and TikTokApi listing (error is None unless it raised),
+# e.g. to feed a metrics collector
+metrics_hook = None
+
+def set_metrics_hook(fn):
+    global metrics_hook
+    metrics_hook = fn
+
+@contextmanager
+def metric_span(name):
+    # times the block and reports it to metrics_hook when it exits, with any
+    # counters set on the yielded dict and the exception if it raised
+    counters = dict()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield counters
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if metrics_hook is not None:
+            metrics_hook(name,time.perf_counter() - started,error,**counters)
+
+def http_get(url,throttle_retries=5,**kwargs):
+    # paced by the per-host token bucket, which backs off on 429/Retry-After
+    bucket = rate_limiter.bucket_for_url(url)
+    if url_rewriter is not None:
+        url = url_rewriter(url)
+    for attempt in range(throttle_retries + 1):
+        rate_limiter.acquire(bucket)
+        resp = get_http_session().get(url,**kwargs)
+        throttled = rate_limiter.report(bucket,resp.status_code,resp.headers.get('Retry-After'))
+        if not throttled or attempt == throttle_retries:
+            return resp
+        resp.close()
+
 def specify_browser(browser):
     global cookies
     cookies = getattr(browser_cookie3,browser)(domain_name='www.tiktok.com')
 
 def deduplicate_metadata(metadata_fn,video_df,dedup_field='video_id'):
-    if os.path.exists(metadata_fn):
-        metadata = pd.read_csv(metadata_fn,keep_default_na=False)
-        combined_data = pd.concat([metadata,video_df])
-        combined_data[dedup_field] = combined_data[dedup_field].astype(str)
-    else:
-        combined_data = video_df
-    return combined_data.drop_duplicates(dedup_field)
+    # rows of video_df not already in metadata_fn, checked against the
+    # writer's sidecar index rather than by reloading the file
+    return get_metadata_writer(metadata_fn,dedup_field).unseen(video_df)
 
-def generate_data_row(video_obj):
-    data_header = ['video_id',
-                   'video_timestamp',
-                   'video_duration',
-                   'video_locationcreated',
-                   'video_diggcount',
-                   'video_sharecount',
-                   'video_commentcount',
-                   'video_playcount',
-                   'video_description',
-                   'video_is_ad',
-                   'video_stickers',
-                   'author_username',
-                   'author_name',
-                   'author_followercount',
-                   'author_followingcount',
-                   'author_heartcount',
-                   'author_videocount',
-                   'author_diggcount',
-                   'author_verified',
-                   'poi_name',
-                   'poi_address',
-                   'poi_city']
-    data_list = []
-    data_list.append(video_obj['id'])
-    try:
-        ctime = video_obj['createTime']
-        data_list.append(datetime.fromtimestamp(int(ctime)).isoformat())
-    except Exception:
-        data_list.append('')
-    try:
-        data_list.append(video_obj['video']['duration'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['locationCreated'])
-    except Exception:
-        data_list.append('')
-    try:
-        data_list.append(video_obj['stats']['diggCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['stats']['shareCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['stats']['commentCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['stats']['playCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['desc'])
-    except Exception:
-        data_list.append('')
-    try:
-        data_list.append(video_obj['isAd'])
-    except Exception:
-        data_list.append(False)
-    try:
-        video_stickers = []
-        for sticker in video_obj['stickersOnItem']:
-            for text in sticker['stickerText']:
-                video_stickers.append(text)
-        data_list.append(';'.join(video_stickers))
-    except Exception:
-        data_list.append('')
-    try:
-        data_list.append(video_obj['author']['uniqueId'])
-    except Exception:
-        try:
-            data_list.append(video_obj['author'])
-        except Exception:
-            data_list.append('')
-    try:
-        data_list.append(video_obj['author']['nickname'])
-    except Exception:
+def join_stickers(stickers):
+    return ';'.join(text for sticker in stickers for text in sticker['stickerText'])
+
+def format_timestamp(ctime):
+    return datetime.fromtimestamp(int(ctime)).isoformat()
+
+# column: (paths tried in order, default if none resolves, transform).
+# 'video_id' has no default: a video object without an id is an error.
+data_schema = {'video_id': ([('id',)],None,None),
+               'video_timestamp': ([('createTime',)],'',format_timestamp),
+               'video_duration': ([('video','duration')],np.nan,None),
+               'video_locationcreated': ([('locationCreated',)],'',None),
+               'video_diggcount': ([('stats','diggCount')],np.nan,None),
+               'video_sharecount': ([('stats','shareCount')],np.nan,None),
+               'video_commentcount': ([('stats','commentCount')],np.nan,None),
+               'video_playcount': ([('stats','playCount')],np.nan,None),
+               'video_description': ([('desc',)],'',None),
+               'video_is_ad': ([('isAd',)],False,None),
+               'video_stickers': ([('stickersOnItem',)],'',join_stickers),
+               # older payloads carry the author as a bare username string
+               'author_username': ([('author','uniqueId'),('author',)],'',None),
+               'author_name': ([('author','nickname'),('nickname',)],'',None),
+               'author_followercount': ([('authorStats','followerCount')],np.nan,None),
+               'author_followingcount': ([('authorStats','followingCount')],np.nan,None),
+               'author_heartcount': ([('authorStats','heartCount')],np.nan,None),
+               'author_videocount': ([('authorStats','videoCount')],np.nan,None),
+               'author_diggcount': ([('authorStats','diggCount')],np.nan,None),
+               'author_verified': ([('author','verified')],False,None),
+               'poi_name': ([('poi','name')],'',None),
+               'poi_address': ([('poi','address')],'',None),
+               'poi_city': ([('poi','city')],'',None)}
+data_header = list(data_schema.keys())
+# flattened once so per-video extraction is a plain loop over tuples
+compiled_schema = [(column,paths,default,transform)
+                   for column,(paths,default,transform) in data_schema.items()]
+
+def extract_field(video_obj,paths,default,transform):
+    for path in paths:
+        value = video_obj
         try:
-            data_list.append(video_obj['nickname'])
+            for key in path:
+                value = value[key]
+            return value if transform is None else transform(value)
         except Exception:
-            data_list.append('')
-    try:
-        data_list.append(video_obj['authorStats']['followerCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['authorStats']['followingCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['authorStats']['heartCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['authorStats']['videoCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['authorStats']['diggCount'])
-    except Exception:
-        data_list.append(np.nan)
-    try:
-        data_list.append(video_obj['author']['verified'])
-    except Exception:
-        data_list.append(False)
-    try:
-        data_list.append(video_obj['poi']['name'])
-    except Exception:
-        data_list.append('')
-    try:
-        data_list.append(video_obj['poi']['address'])
-    except Exception:
-        data_list.append('')
-    try:
-        data_list.append(video_obj['poi']['city'])
-    except Exception:
-        data_list.append('')
-    data_row = pd.DataFrame(dict(zip(data_header,data_list)),index=[0])
-    return data_row
+            continue
+    return default
+
+def generate_data_record(video_obj):
+    record = {'video_id': video_obj['id']}
+    for column,paths,default,transform in compiled_schema[1:]:
+        record[column] = extract_field(video_obj,paths,default,transform)
+    return record
+
+def generate_data_table(video_objs):
+    # many videos -> one DataFrame, built column by column
+    records = [generate_data_record(video_obj) for video_obj in video_objs]
+    return pd.DataFrame({column: [record[column] for record in records]
+                         for column in data_header},
+                        columns=data_header)
+
+def generate_data_row(video_obj):
+    return generate_data_table([video_obj])
+
 #currently unused, but leaving it in case it's needed later
 '''
 def fix_tt_url(tt_url):
@@ -194,137 +234,374 @@ def fix_tt_url(tt_url):
     else:
         return tt_url
 '''
-def get_tiktok_json(video_url,browser_name=None):
+# the two page layouts TikTok serves, by the id of the <script> holding the
+# video JSON; SIGI_STATE is the older one and wins if a page has both
+page_layouts = {'SIGI_STATE':'sigi',
+                '__UNIVERSAL_DATA_FOR_REHYDRATION__':'universal'}
+page_script_regex = re.compile(r'<script\b[^>]*\bid=["\'](' + '|'.join(page_layouts) + r')["\'][^>]*>')
+# how often each layout matched (None: neither did), to see how often the
+# fallback layout fires
+layout_counts = Counter()
+layout_counts_lock = threading.Lock()
+
+def extract_page_json(page_text):
+    # one regex pass over the raw HTML instead of building a DOM
+    found = {}
+    for match in page_script_regex.finditer(page_text):
+        layout = page_layouts[match.group(1)]
+        if layout in found:
+            continue
+        end = page_text.find('</script>',match.end())
+        if end == -1:
+            continue
+        found[layout] = page_text[match.end():end]
+        if layout == 'sigi':
+            break
+    for layout in ['sigi','universal']:
+        if layout in found:
+            try:
+                return layout, json.loads(found[layout])
+            except ValueError:
+                continue
+    return None, None
+
+def fetch_tiktok_json(video_url,browser_name=None):
     if 'cookies' not in globals() and browser_name is None:
         raise BrowserNotSpecifiedError
     global cookies
     if browser_name is not None:
         cookies = getattr(browser_cookie3,browser_name)(domain_name='www.tiktok.com')
-    tt = requests.get(video_url,
-                      headers=headers,
+    with metric_span('pyktok.page') as counters:
+        cache = get_response_cache()
+        cached = cache.lookup('page',video_url)
+        if cached is not None and cached[1]:
+            counters['cache_hits'] = 1
+            return cached[0]['layout'], cached[0]['json']
+        request_headers = headers
+        if cached is not None:
+            # stale: let TikTok answer 304 if the page hasn't changed
+            validators = cached[2]
+            request_headers = dict(headers)
+            if validators['etag'] is not None:
+                request_headers['If-None-Match'] = validators['etag']
+            if validators['last_modified'] is not None:
+                request_headers['If-Modified-Since'] = validators['last_modified']
+        tt = http_get(video_url,
+                      headers=request_headers,
                       cookies=cookies,
                       timeout=20)
-    # retain any new cookies that got set in this request
-    cookies = tt.cookies
-    soup = BeautifulSoup(tt.text, "html.parser")
-    tt_script = soup.find('script', attrs={'id':"SIGI_STATE"})
-    try:
-        tt_json = json.loads(tt_script.string)
-    except AttributeError:
+        # retain any new cookies that got set in this request
+        cookies = tt.cookies
+        if tt.status_code == 304 and cached is not None:
+            cache.refresh('page',video_url)
+            counters['cache_hits'] = 1
+            return cached[0]['layout'], cached[0]['json']
+        counters['bytes'] = len(tt.content)
+        layout, tt_json = extract_page_json(tt.text)
+        with layout_counts_lock:
+            layout_counts[layout] += 1
+        if layout is not None:
+            cache.put('page',video_url,{'layout':layout,'json':tt_json},
+                      etag=tt.headers.get('ETag'),
+                      last_modified=tt.headers.get('Last-Modified'))
+        return layout, tt_json
+
+def get_layout_counts():
+    with layout_counts_lock:
+        return dict(layout_counts)
+
+def get_tiktok_json(video_url,browser_name=None):
+    layout, tt_json = fetch_tiktok_json(video_url,browser_name)
+    if layout != 'sigi':
         return
     return tt_json
 
 def alt_get_tiktok_json(video_url,browser_name=None):
-    if 'cookies' not in globals() and browser_name is None:
-        raise BrowserNotSpecifiedError
-    global cookies
-    if browser_name is not None:
-        cookies = getattr(browser_cookie3,browser_name)(domain_name='www.tiktok.com')
-    tt = requests.get(video_url,
-                      headers=headers,
-                      cookies=cookies,
-                      timeout=20)
-    # retain any new cookies that got set in this request
-    cookies = tt.cookies
-    soup = BeautifulSoup(tt.text, "html.parser")
-    tt_script = soup.find('script', attrs={'id':"__UNIVERSAL_DATA_FOR_REHYDRATION__"})
-    try:
-        tt_json = json.loads(tt_script.string)
-    except AttributeError:
+    layout, tt_json = fetch_tiktok_json(video_url,browser_name)
+    if layout != 'universal':
         print("The function encountered a downstream error and did not deliver any data, which happens periodically for various reasons. Please try again later.")
         return
     return tt_json
 
+def stream_download(file_url,
+                    file_fn,
+                    chunk_size=1 << 16,
+                    progress=None):
+    # stream straight to file_fn in chunks, resuming from the end of a partial
+    # file via an HTTP Range request. `progress`, if given, is called as
+    # progress(bytes_written, total_bytes_or_None) after every chunk.
+    with metric_span('pyktok.download') as counters:
+        counters['bytes'] = 0
+        if os.path.dirname(file_fn) != '':
+            os.makedirs(os.path.dirname(file_fn),exist_ok=True)
+        done = os.path.getsize(file_fn) if os.path.exists(file_fn) else 0
+        # finished downloads are recorded in the response cache (size only), so
+        # replay mode can serve a file an earlier run completed without asking
+        # the CDN, and refuse a missing or partial one
+        cache = get_response_cache()
+        if cache.mode == 'replay':
+            completed = cache.lookup('download',file_url)
+            if completed[0]['bytes'] != done:
+                raise CacheMissError('download',file_url)
+            return done
+        # no content-encoding, so byte ranges refer to the file itself
+        video_headers = {**headers,
+                         'referer': 'https://www.tiktok.com/',
+                         'Accept-Encoding': 'identity'}
+        if done > 0:
+            video_headers['Range'] = 'bytes=' + str(done) + '-'
+        # include cookies with the video request
+        with http_get(file_url,
+                      allow_redirects=True,
+                      headers=video_headers,
+                      cookies=cookies,
+                      stream=True,
+                      timeout=60) as tt_video:
+            if tt_video.status_code == 416:
+                # nothing left past `done`: the file was already complete
+                cache.put('download',file_url,{'bytes':done})
+                return done
+            tt_video.raise_for_status()
+            if tt_video.status_code != 206:
+                # server ignored the range, start over
+                done = 0
+            remaining = tt_video.headers.get('Content-Length')
+            total = done + int(remaining) if remaining is not None else None
+            with open(file_fn, 'ab' if done > 0 else 'wb') as fn:
+                for chunk in tt_video.iter_content(chunk_size=chunk_size):
+                    fn.write(chunk)
+                    done += len(chunk)
+                    counters['bytes'] += len(chunk)
+                    if progress is not None:
+                        progress(done,total)
+        cache.put('download',file_url,{'bytes':done})
+        return done
+
+# CDN answers for a signed video url that has expired (or whose cookies have)
+cdn_expired_codes = [403,404,410]
+
+def save_tiktok_video(video_url,layout,tt_json,video_dir='',progress=None):
+    # download the video (or slideshow images) a page points to; returns the
+    # last file written
+    regex_url = re.findall(url_regex, video_url)[0]
+    if layout == 'sigi':
+        video_id = list(tt_json['ItemModule'].keys())[0]
+        if 'imagePost' in tt_json['ItemModule'][video_id]:
+            slidecount = 1
+            for slide in tt_json['ItemModule'][video_id]['imagePost']['images']:
+                video_fn = os.path.join(video_dir, regex_url.replace('/', '_') + '_slide_' + str(slidecount) + '.jpeg')
+                tt_video_url = slide['imageURL']['urlList'][0]
+                stream_download(tt_video_url, video_fn, progress=progress)
+                slidecount += 1
+        else:
+            video_fn = os.path.join(video_dir, regex_url.replace('/', '_') + '.mp4')
+            tt_video_url = tt_json['ItemModule'][video_id]['video']['downloadAddr']
+            stream_download(tt_video_url, video_fn, progress=progress)
+        print("Saved video\n", tt_video_url, "\nto\n", os.path.abspath(video_dir))
+    else:
+        video_fn = os.path.join(video_dir, regex_url.replace('/', '_') + '.mp4')
+        tt_video_url = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']['video']['playAddr']
+        if tt_video_url == '':
+            tt_video_url = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']['video']['downloadAddr']
+        stream_download(tt_video_url, video_fn, progress=progress)
+        print("Saved video\n", video_url, "\nto\n", os.path.abspath(video_dir))
+    return video_fn
+
 def save_tiktok(video_url,
                 save_video=True,
                 metadata_fn='',
                 browser_name=None,
-                return_fns=False):
+                return_fns=False,
+                video_dir='',
+                progress=None,
+                return_record=False):
     if 'cookies' not in globals() and browser_name is None:
         raise BrowserNotSpecifiedError
-    if save_video == False and metadata_fn == '':
+    if save_video == False and metadata_fn == '' and return_record == False:
         print('Since save_video and metadata_fn are both False/blank, the program did nothing.')
         return
 
-    tt_json = get_tiktok_json(video_url,browser_name)
+    layout, tt_json = fetch_tiktok_json(video_url,browser_name)
+    if layout is None:
+        print("The function encountered a downstream error and did not deliver any data, which happens periodically for various reasons. Please try again later.")
+        return
 
-    if tt_json is not None:
-        video_id = list(tt_json['ItemModule'].keys())[0]
+    if save_video == True:
+        try:
+            video_fn = save_tiktok_video(video_url,layout,tt_json,video_dir,progress)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in cdn_expired_codes:
+                raise
+            # the CDN url in the (possibly cached) page has expired: drop the
+            # page and fetch it again for fresh urls and cookies, once
+            get_response_cache().invalidate('page',video_url)
+            layout, tt_json = fetch_tiktok_json(video_url,browser_name)
+            if layout is None:
+                raise
+            video_fn = save_tiktok_video(video_url,layout,tt_json,video_dir,progress)
 
-        if save_video == True:
-            regex_url = re.findall(url_regex, video_url)[0]
-            if 'imagePost' in tt_json['ItemModule'][video_id]:
-                slidecount = 1
-                for slide in tt_json['ItemModule'][video_id]['imagePost']['images']:
-                    video_fn = regex_url.replace('/', '_') + '_slide_' + str(slidecount) + '.jpeg'
-                    tt_video_url = slide['imageURL']['urlList'][0]
-                    headers['referer'] = 'https://www.tiktok.com/'
-                    # include cookies with the video request
-                    tt_video = requests.get(tt_video_url, allow_redirects=True, headers=headers, cookies=cookies)
-                    with open(video_fn, 'wb') as fn:
-                        fn.write(tt_video.content)
-                    slidecount += 1
-            else:
-                regex_url = re.findall(url_regex, video_url)[0]
-                video_fn = regex_url.replace('/', '_') + '.mp4'
-                tt_video_url = tt_json['ItemModule'][video_id]['video']['downloadAddr']
-                headers['referer'] = 'https://www.tiktok.com/'
-                # include cookies with the video request
-                tt_video = requests.get(tt_video_url, allow_redirects=True, headers=headers, cookies=cookies)
-            with open(video_fn, 'wb') as fn:
-                fn.write(tt_video.content)
-            print("Saved video\n", tt_video_url, "\nto\n", os.getcwd())
+    if layout == 'sigi':
+        video_id = list(tt_json['ItemModule'].keys())[0]
 
-        if metadata_fn != '':
+        if metadata_fn != '' or return_record == True:
             data_slot = tt_json['ItemModule'][video_id]
-            data_row = generate_data_row(data_slot)
+            record = generate_data_record(data_slot)
             try:
                 user_id = list(tt_json['UserModule']['users'].keys())[0]
-                data_row.loc[0,"author_verified"] = tt_json['UserModule']['users'][user_id]['verified']
+                record["author_verified"] = tt_json['UserModule']['users'][user_id]['verified']
             except Exception:
                 pass
-            if os.path.exists(metadata_fn):
-                metadata = pd.read_csv(metadata_fn,keep_default_na=False)
-                combined_data = pd.concat([metadata,data_row])
-            else:
-                combined_data = data_row
-            combined_data.to_csv(metadata_fn,index=False)
 
     else:
-        tt_json = alt_get_tiktok_json(video_url,browser_name)
-        if save_video == True:
-            regex_url = re.findall(url_regex, video_url)[0]
-            video_fn = regex_url.replace('/', '_') + '.mp4'
-            tt_video_url = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']['video']['playAddr']
-            if tt_video_url == '':
-                tt_video_url = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']['video']['downloadAddr']
-            headers['referer'] = 'https://www.tiktok.com/'
-            # include cookies with the video request
-            tt_video = requests.get(tt_video_url, allow_redirects=True, headers=headers, cookies=cookies)
-            with open(video_fn, 'wb') as fn:
-                fn.write(tt_video.content)
-            print("Saved video\n", video_url, "\nto\n", os.getcwd())
-
-        if metadata_fn != '':
+        if metadata_fn != '' or return_record == True:
             data_slot = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']
-            data_row = generate_data_row(data_slot)
+            record = generate_data_record(data_slot)
+
+    # with return_record the caller gets the metadata record and writes (or
+    # batches) it itself instead of it going to metadata_fn
+    if metadata_fn != '' and return_record == False:
+        get_metadata_writer(metadata_fn,'video_id').append(generate_data_table([record]))
+        print("Saved metadata for video\n", video_url, "\nto\n", os.getcwd())
+
+    if return_fns == True:
+        fns = {'video_fn':video_fn if save_video else '','metadata_fn':metadata_fn}
+        if return_record == True:
+            fns['record'] = record
+        return fns
+    if return_record == True:
+        return record
+
+# one long-lived TikTokApi instance (and its headless browser) shared by every
+# comment and user-video call, instead of launching a browser per call
+
+class TikTokSessionPool:
+    def __init__(self,num_sessions=tiktok_sessions,headless=True,sleep_after=3):
+        self.num_sessions = num_sessions
+        self.headless = headless
+        self.sleep_after = sleep_after
+        self.api = None
+        self._next_session = 0
+        self._lock = threading.Lock()
+        self._started = None
+        # all Playwright objects live on this loop, which runs in its own thread
+        # so sync callers and other event loops can hand it work
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='pyktok-sessions',
+                                        daemon=True)
+        self._thread.start()
+
+    async def _start(self):
+        api = TikTokApi()
+        try:
+            await api.create_sessions(headless=self.headless,
+                                      ms_tokens=[ms_token],
+                                      num_sessions=self.num_sessions,
+                                      sleep_after=self.sleep_after,
+                                      context_options=context_dict)
+        except Exception:
+            # don't leave a half-started browser behind
             try:
-                data_row.loc[0,"author_verified"] = tt_json["__DEFAULT_SCOPE__"]['webapp.video-detail']['itemInfo']['itemStruct']['author']
+                await api.close_sessions()
+                await api.stop_playwright()
             except Exception:
                 pass
-            if os.path.exists(metadata_fn):
-                metadata = pd.read_csv(metadata_fn,keep_default_na=False)
-                combined_data = pd.concat([metadata,data_row])
-            else:
-                combined_data = data_row
-            combined_data.to_csv(metadata_fn,index=False)
-            print("Saved metadata for video\n", video_url, "\nto\n", os.getcwd())
+            raise
+        self.api = api
+        return api
+
+    async def get_api(self):
+        # must be awaited on self.loop
+        if self._started is None:
+            self._started = asyncio.ensure_future(self._start())
+        started = self._started
+        try:
+            return await started
+        except Exception:
+            # a failed start is not remembered: the next call tries again
+            if self._started is started:
+                self._started = None
+            raise
 
-        if return_fns == True:
-            return {'video_fn':video_fn,'metadata_fn':metadata_fn}
+    def next_session_index(self):
+        with self._lock:
+            session_index = self._next_session
+            self._next_session = (self._next_session + 1) % self.num_sessions
+        return session_index
+
+    def submit(self,coro):
+        return asyncio.run_coroutine_threadsafe(coro,self.loop)
+
+    def call(self,coro):
+        return self.submit(coro).result()
+
+    async def _stop(self):
+        if self.api is not None:
+            await self.api.close_sessions()
+            await self.api.stop_playwright()
+            self.api = None
+
+    def close(self):
+        if self.loop.is_running():
+            try:
+                self.call(self._stop())
+            finally:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self._thread.join()
+
+# one pool per `headless` value, so a caller asking for a visible browser
+# gets one even if a headless pool already exists
+global session_pools
+session_pools = dict()
+session_pool_lock = threading.Lock()
+
+def get_session_pool(headless=True):
+    with session_pool_lock:
+        if headless not in session_pools:
+            session_pools[headless] = TikTokSessionPool(headless=headless)
+            atexit.register(session_pools[headless].close)
+        return session_pools[headless]
+
+async def run_in_session_pool(coro,headless=True):
+    pool = get_session_pool(headless)
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is pool.loop:
+        return await coro
+    return await asyncio.wrap_future(pool.submit(coro))
 
 # the function below is based on this one: https://github.com/davidteather/TikTok-Api/blob/main/examples/user_example.py
 
+async def _list_videos(tt_ent,ent_type,video_ct,headless):
+    pool = get_session_pool(headless)
+    api = await pool.get_api()
+    await rate_limiter.acquire_async('tiktok')
+    session_index = pool.next_session_index()
+    if ent_type == 'user':
+        ent = api.user(tt_ent)
+    elif ent_type == 'hashtag':
+        ent = api.hashtag(name=tt_ent)
+    else:
+        ent = api.video(url=tt_ent)
+
+    tt_list = []
+    got_videos = 0
+    if ent_type in ['user','hashtag']:
+        async for video in ent.videos(count=video_ct,session_index=session_index):
+            tt_list.append(video.as_dict)
+            got_videos += 1
+            if got_videos >= video_ct:
+                break
+    else:
+        async for related_video in ent.related_videos(count=video_ct,session_index=session_index):
+            tt_list.append(related_video.as_dict)
+            got_videos += 1
+            if got_videos >= video_ct:
+                break
+    return tt_list
+
 async def get_video_urls(tt_ent,
                          ent_type="user",
                          video_ct=30,
@@ -332,62 +609,89 @@ async def get_video_urls(tt_ent,
     if ent_type not in ['user','hashtag','video_related']:
         raise Exception('Only allowed `ent_type` values are "user", "hashtag", or "video_related".')
 
-    url_p1 = "https://www.tiktok.com/@"
-    url_p2 = "/video/"
-    tt_list = []
+    with metric_span('pyktok.user_videos') as counters:
+        cache = get_response_cache()
+        cache_key = ent_type + ':' + tt_ent + ':' + str(video_ct)
+        video_list = cache.get('user_videos',cache_key)
+        if video_list is not None:
+            counters['cache_hits'] = 1
+            return video_list
 
-    async with TikTokApi() as api:
-        await api.create_sessions(headless=headless,
-                                  ms_tokens=[ms_token],
-                                  num_sessions=1,
-                                  sleep_after=3,
-                                  context_options=context_dict)
+        url_p1 = "https://www.tiktok.com/@"
+        url_p2 = "/video/"
+        tt_list = await run_in_session_pool(_list_videos(tt_ent,ent_type,video_ct,headless),
+                                            headless)
+        id_list = [i['id'] for i in tt_list]
         if ent_type == 'user':
-            ent = api.user(tt_ent)
-        elif ent_type == 'hashtag':
-            ent = api.hashtag(name=tt_ent)
-        else:
-            ent = api.video(url=tt_ent)
-
-        got_videos = 0
-        if ent_type in ['user','hashtag']:
-            async for video in ent.videos(count=video_ct):
-                tt_list.append(video.as_dict)
-                got_videos += 1
-                if got_videos >= video_ct:
-                    break
+            video_list = [url_p1 + tt_ent + url_p2 + i for i in id_list]
         else:
-            async for related_video in ent.related_videos(count=video_ct):
-                tt_list.append(related_video.as_dict)
-                got_videos += 1
-                if got_videos >= video_ct:
-                    break
-    id_list = [i['id'] for i in tt_list]
-    if ent_type == 'user':
-        video_list = [url_p1 + tt_ent + url_p2 + i for i in id_list]
-    else:
-        author_list = [i['author']['uniqueId'] for i in tt_list]
-        video_list = []
-        for n, i in enumerate(author_list):
-            video_url = url_p1 + author_list[n] + url_p2 + id_list[n]
-            video_list.append(video_url)
-    return video_list
+            author_list = [i['author']['uniqueId'] for i in tt_list]
+            video_list = []
+            for n, i in enumerate(author_list):
+                video_url = url_p1 + author_list[n] + url_p2 + id_list[n]
+                video_list.append(video_url)
+        cache.put('user_videos',cache_key,video_list)
+        return video_list
+
+def append_metadata_records(metadata_fn,records):
+    # one append for a whole batch of records
+    if len(records) == 0:
+        return
+    batch = pd.DataFrame(records,columns=data_header)
+    get_metadata_writer(metadata_fn,'video_id').append(batch)
 
 def save_tiktok_multi_urls(video_urls,
                            save_video=True,
                            metadata_fn='',
                            sleep=4,
-                           browser_name=None):
+                           browser_name=None,
+                           workers=4,
+                           rate=None,
+                           flush_every=50):
     if 'cookies' not in globals() and browser_name is None:
         raise BrowserNotSpecifiedError
     if type(video_urls) is str:
         tt_urls = open(video_urls).read().splitlines()
     else:
         tt_urls = video_urls
-    for u in tt_urls:
-        save_tiktok(u,save_video,metadata_fn,browser_name)
-        time.sleep(random.randint(1, sleep))
-    print('Saved',len(tt_urls),'videos and/or lines of metadata')
+    # `sleep` is kept for compatibility only: requests are now paced by the
+    # shared rate limiter (tune it with `rate`, in page fetches per second)
+    # instead of a blind random sleep
+    if rate is not None:
+        rate_limiter.configure('tiktok',rate)
+    records = []
+    failed = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(save_tiktok,u,save_video,metadata_fn,browser_name,
+                                       return_record=metadata_fn != ''): u
+                       for u in tt_urls}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+                    print('Failed to save',futures[future],':',e)
+                    continue
+                if metadata_fn != '' and record is None:
+                    # the page came back without video JSON (e.g. a block page)
+                    failed[futures[future]] = Exception('no video data on the page')
+                    continue
+                if metadata_fn != '':
+                    records.append(record)
+                    if len(records) >= flush_every:
+                        append_metadata_records(metadata_fn,records)
+                        records = []
+        if metadata_fn != '':
+            append_metadata_records(metadata_fn,records)
+    finally:
+        if metadata_fn != '':
+            # done with this file: don't keep its writer (and sidecar handle) open
+            release_metadata_writer(metadata_fn)
+    print('Saved',len(tt_urls) - len(failed),'videos and/or lines of metadata')
+    if len(failed) > 0:
+        print('Failed to save',len(failed),'of',len(tt_urls),'urls')
+    return failed
 
 def save_tiktok_multi_page(tt_ent,
                            ent_type="user",
@@ -397,11 +701,12 @@ def save_tiktok_multi_page(tt_ent,
                            metadata_fn='',
                            sleep=4,
                            browser_name=None):
-    video_urls = asyncio.run(get_video_urls(tt_ent,
-                                            ent_type,
-                                            video_ct,
-                                            headless))
-    save_tiktok_multi_urls(video_urls,
+    # returns the {url: exception} of videos that couldn't be saved
+    video_urls = get_session_pool(headless).call(get_video_urls(tt_ent,
+                                                                ent_type,
+                                                                video_ct,
+                                                                headless))
+    return save_tiktok_multi_urls(video_urls,
                            save_video,
                            metadata_fn,
                            sleep,
@@ -409,17 +714,28 @@ def save_tiktok_multi_page(tt_ent,
 
 # the function below is based on this one: https://github.com/davidteather/TikTok-Api/blob/main/examples/comment_example.py
 
-async def get_comments(video_id,comment_count=30,headless=True):
+async def _list_comments(video_id,comment_count,headless):
+    pool = get_session_pool(headless)
+    api = await pool.get_api()
+    await rate_limiter.acquire_async('tiktok')
     comment_list = []
-    async with TikTokApi() as api:
-        await api.create_sessions(headless=headless,
-                                  ms_tokens=[ms_token],
-                                  num_sessions=1,
-                                  sleep_after=3,
-                                  context_options=context_dict)
-        video = api.video(id=video_id)
-        async for comment in video.comments(count=comment_count):
-            comment_list.append(comment.as_dict)
+    video = api.video(id=video_id)
+    async for comment in video.comments(count=comment_count,
+                                        session_index=pool.next_session_index()):
+        comment_list.append(comment.as_dict)
+    return comment_list
+
+async def get_comments(video_id,comment_count=30,headless=True):
+    with metric_span('pyktok.comments') as counters:
+        cache = get_response_cache()
+        cache_key = str(video_id) + ':' + str(comment_count)
+        comment_list = cache.get('comments',cache_key)
+        if comment_list is None:
+            comment_list = await run_in_session_pool(_list_comments(video_id,comment_count,headless),
+                                                     headless)
+            cache.put('comments',cache_key,comment_list)
+        else:
+            counters['cache_hits'] = 1
     return pd.DataFrame(comment_list)
 
 def save_tiktok_comments(video_url,
@@ -429,13 +745,12 @@ def save_tiktok_comments(video_url,
                          save_comments=True,
                          return_comments=True):
     video_id = int(re.findall(video_id_regex,video_url)[0])
-    comment_results = asyncio.run(get_comments(video_id,comment_count,headless))
+    comment_results = get_session_pool(headless).call(get_comments(video_id,comment_count,headless))
     if save_comments:
         if filename == '':
             regex_url = re.findall(url_regex, video_url)[0]
             filename = regex_url.replace('/', '_') + '_comments.csv'
-        data_to_save = deduplicate_metadata(filename,comment_results,'cid')
-        data_to_save.to_csv(filename,mode='w',index=False)
-        print(len(comment_results),"comments saved.")
+        saved_ct = get_metadata_writer(filename,'cid').append(comment_results)
+        print(saved_ct,"new comments saved.")
     if return_comments:
         return comment_results
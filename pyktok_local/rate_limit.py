@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive per-host token buckets shared by every TikTok and OpenAI caller.
+
+Each bucket starts at a nominal rate, halves it on a 429 (and waits out any
+Retry-After), then creeps back up on every success. Sync callers block in
+acquire() / call(); async callers await acquire_async() / call_async().
+"""
+
+import asyncio
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from urllib.parse import urlparse
+
+# name: (requests per second, burst)
+default_rates = {'tiktok': (2.0, 4),         # www.tiktok.com page fetches + TikTokApi calls
+                 'tiktok-cdn': (8.0, 8),     # video / image downloads
+                 'openai-chat': (5.0, 10),
+                 'openai-audio': (1.0, 3),
+                 'default': (10.0, 10)}
+
+tiktok_page_hosts = {'tiktok.com','www.tiktok.com','m.tiktok.com','vm.tiktok.com'}
+tiktok_cdn_markers = ['tiktok','byteoversea','ibyteimg','muscdn']
+
+def parse_retry_after(value):
+    # Retry-After is either delay-seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(float(value),0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(),0.0)
+    except (TypeError,ValueError):
+        return None
+
+class TokenBucket:
+    def __init__(self,rate,burst,min_rate=None,max_rate=None):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate if min_rate is not None else rate / 20
+        self.max_rate = max_rate if max_rate is not None else rate
+        # additive increase per success; getting back from min_rate takes ~50 calls
+        self.rate_step = (self.max_rate - self.min_rate) / 50
+        self.tokens = float(burst)
+        self.throttled = 0
+        self._blocked_until = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # take a token (possibly going into debt) and return how long to wait for it
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def on_throttle(self,retry_after=None):
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+class RateLimiter:
+    def __init__(self,rates=None):
+        self.rates = dict(default_rates if rates is None else rates)
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def configure(self,name,rate,burst=None):
+        with self._lock:
+            self.rates[name] = (rate, burst if burst is not None else max(int(rate),1))
+            self.buckets.pop(name, None)
+
+    def bucket(self,name):
+        with self._lock:
+            if name not in self.buckets:
+                rate, burst = self.rates.get(name, self.rates['default'])
+                self.buckets[name] = TokenBucket(rate,burst)
+            return self.buckets[name]
+
+    def bucket_for_url(self,url):
+        host = (urlparse(url).hostname or '').lower()
+        if host in tiktok_page_hosts:
+            return 'tiktok'
+        if any(marker in host for marker in tiktok_cdn_markers):
+            return 'tiktok-cdn'
+        return 'default'
+
+    def acquire(self,name):
+        self.bucket(name).acquire()
+
+    async def acquire_async(self,name):
+        await self.bucket(name).acquire_async()
+
+    def report(self,name,status_code,retry_after=None):
+        # feed a response back; returns True if the caller was throttled
+        if status_code == 429:
+            self.bucket(name).on_throttle(parse_retry_after(retry_after))
+            return True
+        if status_code is not None and status_code < 400:
+            self.bucket(name).on_success()
+        return False
+
+    def call(self,name,fn,*args,retries=5,retry_on=(),**kwargs):
+        # run fn under the bucket, retrying on 429 (after slowing down), 5xx and
+        # any exception type in retry_on. Exceptions are expected to carry
+        # .status_code / .response like the OpenAI client's APIStatusError.
+        for attempt in range(retries + 1):
+            self.acquire(name)
+            try:
+                result = fn(*args,**kwargs)
+            except Exception as e:
+                status_code = getattr(e,'status_code',None)
+                response = getattr(e,'response',None)
+                retry_after = response.headers.get('retry-after') if response is not None else None
+                throttled = self.report(name,status_code,retry_after)
+                retriable = (throttled
+                             or (status_code is not None and status_code >= 500)
+                             or isinstance(e,retry_on))
+                if not retriable or attempt == retries:
+                    raise
+                if not throttled:
+                    time.sleep(min(2 ** attempt,30))
+                continue
+            self.bucket(name).on_success()
+            return result
+
+    async def call_async(self,name,fn,*args,retries=5,retry_on=(),**kwargs):
+        # call() for coroutine functions: waits without blocking the event loop
+        for attempt in range(retries + 1):
+            await self.acquire_async(name)
+            try:
+                result = await fn(*args,**kwargs)
+            except Exception as e:
+                status_code = getattr(e,'status_code',None)
+                response = getattr(e,'response',None)
+                retry_after = response.headers.get('retry-after') if response is not None else None
+                throttled = self.report(name,status_code,retry_after)
+                retriable = (throttled
+                             or (status_code is not None and status_code >= 500)
+                             or isinstance(e,retry_on))
+                if not retriable or attempt == retries:
+                    raise
+                if not throttled:
+                    await asyncio.sleep(min(2 ** attempt,30))
+                continue
+            self.bucket(name).on_success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {name: {'rate': bucket.rate, 'throttled': bucket.throttled}
+                    for name, bucket in self.buckets.items()}
+
+rate_limiter = RateLimiter()
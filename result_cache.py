@@ -0,0 +1,62 @@
+# result_cache.py
+import json
+import time
+import sqlite3
+import threading
+
+from sqlite_lru import SizeCap
+
+RESULT_CACHE_FILE = "result_cache.db"
+RESULT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+class ResultCache:
+    """Persistent key -> JSON result cache with size-capped LRU eviction."""
+
+    def __init__(self, path: str = RESULT_CACHE_FILE, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used);
+        """)
+        self._size_cap = SizeCap(self._db, "results", ["key"], max_bytes)
+
+    def get(self, key: str):
+        """Returns the cached result for key, or None. Counts a hit or miss."""
+        with self._lock, self._db:
+            row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+
+    def put(self, key: str, value):
+        """Stores a JSON-serializable result, then evicts LRU entries until under max_bytes."""
+        serialized = json.dumps(value)
+        size = len(serialized.encode())
+        with self._lock, self._db:
+            old_size = self._size_cap.size_of((key,))
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                             (key, serialized, size, time.time()))
+            self._size_cap.replaced(old_size, size)
+
+    def stats(self) -> dict:
+        """Hits, misses and hit rate since this cache was opened."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,48 @@
+# sqlite_lru.py
+"""Size cap with least-recently-used eviction for a SQLite cache table.
+
+The table needs a `size` column (bytes per entry) and a `last_used` column.
+The total size is summed once when the cache opens and then kept current as
+entries are written and evicted, so a write never re-sums the whole table.
+Callers hold their own lock and transaction around every call.
+"""
+
+EVICT_BATCH = 64
+
+class SizeCap:
+    def __init__(self, db, table: str, key_columns: list, max_bytes: int):
+        self._db = db
+        self.table = table
+        self.key_columns = list(key_columns)
+        self.max_bytes = max_bytes
+        self._where = " AND ".join(column + " = ?" for column in self.key_columns)
+        self.total = db.execute("SELECT COALESCE(SUM(size), 0) FROM " + table).fetchone()[0]
+
+    def size_of(self, key: tuple) -> int:
+        """Bytes stored under key (a tuple of key_columns values), 0 if absent."""
+        row = self._db.execute("SELECT size FROM " + self.table + " WHERE " + self._where,
+                               tuple(key)).fetchone()
+        return row[0] if row is not None else 0
+
+    def replaced(self, old_size: int, new_size: int):
+        """An entry of old_size bytes (0 if it is new) now holds new_size bytes."""
+        self.total += new_size - old_size
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the table is under max_bytes."""
+        columns = ", ".join(self.key_columns)
+        while self.total > self.max_bytes:
+            rows = self._db.execute("SELECT " + columns + ", size FROM " + self.table +
+                                    " ORDER BY last_used LIMIT ?", (EVICT_BATCH,)).fetchall()
+            if len(rows) == 0:
+                self.total = 0
+                return
+            for row in rows:
+                if self.total <= self.max_bytes:
+                    return
+                self._db.execute("DELETE FROM " + self.table + " WHERE " + self._where, row[:-1])
+                self.total -= row[-1]
+
+    def cleared(self):
+        self.total = 0
@@ -0,0 +1,104 @@
+# suspicion.py
+import math
+
+from crawl_state import CRAWL_STATE_DB, get_crawl_state_db
+
+MAX_CHECK_COMMENTERS_PER_VIDEO = 20
+
+def comment_suspicion(comment: dict) -> float:
+    """How much one comment on a bad video raises its author's suspicion score."""
+    score = 10  # We saw this user commenting
+    if comment['is_top_list_marked']:
+        score += 5
+    if comment['is_liked_by_author']:
+        score += 10
+    if comment['likes'] > 0:
+        score += math.log(comment['likes'], 2) + 1
+    return score
+
+class SuspicionLedger:
+    """Persistent, incrementally updated suspicion scores for commenters on bad videos.
+
+    Each bad video's comments are scored exactly once (apply_video), and
+    clean and bad users are kept as sets. Which users to check next is up to
+    the crawl frontier, which apply_video's updated scores are pushed to.
+    """
+
+    def __init__(self, path: str = CRAWL_STATE_DB):
+        self.path = path
+        self._db, self._lock = get_crawl_state_db(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS suspicion_scores (
+                username TEXT PRIMARY KEY,
+                score REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS scored_videos (
+                url TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS checked_users (
+                username TEXT PRIMARY KEY,
+                status TEXT NOT NULL
+            );
+        """)
+        self.scores = dict(self._db.execute("SELECT username, score FROM suspicion_scores"))
+        self.scored_videos = {url for url, in self._db.execute("SELECT url FROM scored_videos")}
+        self.clean_users = set()
+        self.bad_users = set()
+        for username, status in self._db.execute("SELECT username, status FROM checked_users"):
+            (self.bad_users if status == "bad" else self.clean_users).add(username)
+
+    def is_excluded(self, username: str) -> bool:
+        """Already checked, or already known to post bad videos."""
+        return username in self.clean_users or username in self.bad_users
+
+    def apply_video(self, url: str, record: dict) -> dict:
+        """Add score deltas from a newly flagged video's comments.
+
+        Returns {username: new score} for every commenter whose score changed
+        ({} if the video was already applied).
+        """
+        with self._lock:
+            if url in self.scored_videos:
+                return {}
+            deltas = {}
+            for comment in (record.get('comments') or [])[:MAX_CHECK_COMMENTERS_PER_VIDEO]:
+                username = comment['username']
+                deltas[username] = deltas.get(username, 0) + comment_suspicion(comment)
+            with self._db:
+                for username, delta in deltas.items():
+                    self.scores[username] = self.scores.get(username, 0) + delta
+                    self._db.execute("""
+                        INSERT INTO suspicion_scores VALUES (?, ?)
+                        ON CONFLICT(username) DO UPDATE SET score = excluded.score""",
+                        (username, self.scores[username]))
+                self._db.execute("INSERT INTO scored_videos VALUES (?)", (url,))
+            self.scored_videos.add(url)
+            if record.get('username'):
+                self.mark_bad(record['username'])
+            return {username: self.scores[username] for username in deltas}
+
+    def _mark(self, username: str, status: str):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO checked_users VALUES (?, ?)", (username, status))
+
+    def mark_clean(self, username: str):
+        with self._lock:
+            self.clean_users.add(username)
+            self._mark(username, "clean")
+
+    def mark_bad(self, username: str):
+        with self._lock:
+            self.clean_users.discard(username)
+            self.bad_users.add(username)
+            self._mark(username, "bad")
+
+    def reset(self):
+        """Drop every score, scored video and checked user, for a fresh crawl."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM suspicion_scores")
+            self._db.execute("DELETE FROM scored_videos")
+            self._db.execute("DELETE FROM checked_users")
+            self.scores.clear()
+            self.scored_videos.clear()
+            self.clean_users.clear()
+            self.bad_users.clear()
@@ -1,7 +1,8 @@
 from openai import OpenAI
-from moviepy.editor import VideoFileClip
 import os
 
+from audio import extract_audio_to_file
+
 def transcribe_mp4(filename: str) -> dict:
     """
     Extract audio from MP4 file and transcribe using OpenAI Whisper API
@@ -13,9 +14,8 @@ def transcribe_mp4(filename: str) -> dict:
         dict: Whisper API response containing transcription and word-level timestamps
     """
     # Extract audio from video
-    video = VideoFileClip(filename)
     audio_filename = filename.replace('.mp4', '.mp3')
-    video.audio.write_audiofile(audio_filename)
+    extract_audio_to_file(filename, audio_filename)
     
     # Initialize OpenAI client
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
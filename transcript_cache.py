@@ -0,0 +1,124 @@
+# transcript_cache.py
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+from sqlite_lru import SizeCap
+
+TRANSCRIPT_CACHE_FILE = "transcript_cache.db"
+TRANSCRIPT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+video_id_regex = re.compile(r"/video/([0-9]+)")
+
+def video_id_from_url(url: str):
+    """Returns the numeric TikTok video id in a url, or None."""
+    match = video_id_regex.search(url)
+    return match.group(1) if match else None
+
+def hash_audio(audio_bytes: bytes) -> str:
+    """Content hash of extracted audio."""
+    return hashlib.sha256(audio_bytes).hexdigest()
+
+class TranscriptCache:
+    """Persistent transcript cache keyed on audio hash, with video id as a secondary key.
+
+    Entries are evicted least-recently-used first once the stored transcripts
+    exceed max_bytes.
+    """
+
+    def __init__(self, path: str = TRANSCRIPT_CACHE_FILE, max_bytes: int = TRANSCRIPT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.video_id_hits = 0
+        self.audio_hash_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS transcripts (
+                audio_hash TEXT PRIMARY KEY,
+                transcript TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS video_ids (
+                video_id TEXT PRIMARY KEY,
+                audio_hash TEXT NOT NULL REFERENCES transcripts(audio_hash) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts(last_used);
+            CREATE INDEX IF NOT EXISTS video_ids_audio_hash ON video_ids(audio_hash);
+        """)
+        self._size_cap = SizeCap(self._db, "transcripts", ["audio_hash"], max_bytes)
+
+    def _touch(self, audio_hash: str):
+        self._db.execute("UPDATE transcripts SET last_used = ? WHERE audio_hash = ?",
+                         (time.time(), audio_hash))
+
+    def get_by_video_id(self, video_id: str):
+        """Returns cached transcript for a video id, or None.
+
+        Only hits are counted here: a miss falls through to get_by_audio_hash,
+        which counts the lookup's final outcome.
+        """
+        with self._lock, self._db:
+            row = self._db.execute("""
+                SELECT t.audio_hash, t.transcript FROM video_ids v
+                JOIN transcripts t ON t.audio_hash = v.audio_hash
+                WHERE v.video_id = ?""", (video_id,)).fetchone()
+            if row is None:
+                return None
+            self.video_id_hits += 1
+            self._touch(row[0])
+            return row[1]
+
+    def get_by_audio_hash(self, audio_hash: str, video_id: str = None):
+        """Returns cached transcript for an audio hash, or None. Counts a hit or miss.
+
+        On a hit, video_id (if given) is linked to the entry so the next lookup
+        for that video can skip audio extraction.
+        """
+        with self._lock, self._db:
+            row = self._db.execute("SELECT transcript FROM transcripts WHERE audio_hash = ?",
+                                   (audio_hash,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.audio_hash_hits += 1
+            self._touch(audio_hash)
+            if video_id is not None:
+                self._db.execute("INSERT OR REPLACE INTO video_ids VALUES (?, ?)",
+                                 (video_id, audio_hash))
+            return row[0]
+
+    def put(self, audio_hash: str, transcript: str, video_id: str = None):
+        """Stores a transcript, then evicts LRU entries until under max_bytes."""
+        size = len(transcript.encode())
+        with self._lock, self._db:
+            old_size = self._size_cap.size_of((audio_hash,))
+            self._db.execute("""
+                INSERT INTO transcripts VALUES (?, ?, ?, ?)
+                ON CONFLICT(audio_hash) DO UPDATE SET
+                    transcript = excluded.transcript,
+                    size = excluded.size,
+                    last_used = excluded.last_used""",
+                             (audio_hash, transcript, size, time.time()))
+            if video_id is not None:
+                self._db.execute("INSERT OR REPLACE INTO video_ids VALUES (?, ?)",
+                                 (video_id, audio_hash))
+            self._size_cap.replaced(old_size, size)
+
+    def stats(self) -> dict:
+        """Hit counts by lookup (video id, audio hash) plus misses, since startup."""
+        with self._lock:
+            hits = self.video_id_hits + self.audio_hash_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "video_id_hits": self.video_id_hits,
+                "audio_hash_hits": self.audio_hash_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
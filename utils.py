@@ -2,30 +2,48 @@
 import os
 import re
 import csv
+import asyncio
 import ast
 import json
 import hashlib
+import threading
 import pandas as pd
 from typing import Tuple
 from pydantic import BaseModel
 from datetime import datetime, timezone
 
-from openai import OpenAI
-from moviepy.editor import VideoFileClip
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError
 
-from pyktok_local.pyktok import specify_browser, save_tiktok, save_tiktok_comments, save_tiktok_multi_page
+from audio import extract_audio, audio_seconds, AUDIO_FILENAME
+from metrics import get_metrics, timed
+from transcript_cache import TranscriptCache, hash_audio, video_id_from_url
+from result_cache import ResultCache
+from narrative_classifier import NarrativeClassifier, parse_narratives
+from metadata_store import SqliteMetadataStore
+from metadata_index import MetadataIndex
 
-PYK_BROWSER = 'firefox' 
+from pyktok_local.pyktok import specify_browser, save_tiktok, save_tiktok_comments, save_tiktok_multi_page, set_metrics_hook
+from pyktok_local.rate_limit import rate_limiter
+from pyktok_local.metadata_writer import remove_metadata_file
 
 from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# Browser to read TikTok cookies from; set PYK_BROWSER= (empty) to skip
+# cookie extraction, e.g. when running against benchmark.py's stand-in server
+PYK_BROWSER = os.getenv("PYK_BROWSER", "firefox") or None
 
-specify_browser(PYK_BROWSER)
+if PYK_BROWSER is not None:
+    specify_browser(PYK_BROWSER)
 
 metadata = {}
+# guards `metadata` now that the crawl scheduler runs stages from worker threads
+metadata_lock = threading.RLock()
 METADATA_FILE = "metadata.json"
+BAD_VIDEOS_FILE = "bad_videos_metadata.json"
+METADATA_DB = "metadata.db"
 DATA_DIR = "tiktok_data/"
 
 ### OpenAI client
@@ -34,9 +52,92 @@ client = None
 def get_openai_client():
     global client
     if client == None:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # retries are done by openai_call, so 429s can slow the shared rate limiter
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
     return client
 
+def openai_call(bucket: str, fn, *args, **kwargs):
+    """Call an OpenAI client method under the "openai-chat" / "openai-audio" rate limit.
+
+    Recorded in metrics as "openai.<bucket>", with token usage when the response has it.
+    """
+    with get_metrics().span(f"openai.{bucket}") as counters:
+        response = rate_limiter.call(bucket, fn, *args, retry_on=(APIConnectionError,), **kwargs)
+        _count_usage(counters, response)
+        return response
+
+def _count_usage(counters: dict, response):
+    # chat completions report usage; whisper-1 transcriptions don't
+    usage = getattr(response, "usage", None)
+    if getattr(usage, "prompt_tokens", None) is not None:
+        counters["prompt_tokens"] = usage.prompt_tokens
+        counters["completion_tokens"] = usage.completion_tokens
+
+# Most OpenAI requests the async client may have in flight at once, across
+# every task on the loop (also the size of its HTTP connection pool)
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", 16))
+
+async_client = None
+async_client_loop = None
+openai_in_flight = None
+def get_async_openai_client():
+    """AsyncOpenAI client for the running event loop.
+
+    The client's connection pool and the in-flight semaphore belong to one
+    event loop, so (like the crawl scheduler's semaphores) they are rebuilt
+    when a new roach cycle starts a new loop.
+    """
+    global async_client, async_client_loop, openai_in_flight
+    loop = asyncio.get_running_loop()
+    if async_client == None or async_client_loop is not loop:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=OPENAI_MAX_IN_FLIGHT,
+                                max_keepalive_connections=OPENAI_MAX_IN_FLIGHT))
+        async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0,
+                                   http_client=http_client)
+        async_client_loop = loop
+        openai_in_flight = asyncio.Semaphore(OPENAI_MAX_IN_FLIGHT)
+    return async_client
+
+async def close_async_openai_client():
+    """Close the current loop's client (and its connection pool) before the loop ends."""
+    global async_client, async_client_loop, openai_in_flight
+    if async_client is not None:
+        client, async_client, async_client_loop, openai_in_flight = async_client, None, None, None
+        await client.close()
+
+async def openai_call_async(bucket: str, fn, *args, **kwargs):
+    """openai_call for AsyncOpenAI methods.
+
+    Each request holds one of OPENAI_MAX_IN_FLIGHT slots only while it is
+    being sent, not while the rate limiter waits or backs off between tries.
+    """
+    get_async_openai_client()
+    in_flight = openai_in_flight
+
+    async def send(*args, **kwargs):
+        async with in_flight:
+            return await fn(*args, **kwargs)
+
+    with get_metrics().span(f"openai.{bucket}") as counters:
+        response = await rate_limiter.call_async(bucket, send, *args,
+                                                 retry_on=(APIConnectionError,), **kwargs)
+        _count_usage(counters, response)
+        return response
+
+# page fetches, downloads and TikTokApi listings go to the same metrics log
+set_metrics_hook(lambda name, seconds, error, **counters:
+                 get_metrics().record(name, seconds, error, **counters))
+
+### Transcript cache
+
+transcript_cache = None
+def get_transcript_cache():
+    global transcript_cache
+    if transcript_cache == None:
+        transcript_cache = TranscriptCache()
+    return transcript_cache
+
 ### URL helpers
 
 def clean_url(url: str) -> str:
@@ -49,103 +150,157 @@ def hash_url(url: str) -> str:
 
 ### Metadata helpers
 
-def write_metadata():
-    """Write metadata to disk. Slow, call sparingly."""
-    with open('metadata.json', 'w') as f:
-        f.write(json.dumps(metadata))
+# Records live in a SQLite store, one collection per old JSON file
+# ("metadata.json" -> "metadata"); `metadata` is the in-memory view of the
+# current run's collection.
+metadata_store = None
+def get_metadata_store():
+    global metadata_store
+    if metadata_store == None:
+        metadata_store = SqliteMetadataStore(METADATA_DB)
+    return metadata_store
+
+# collection -> MetadataIndex (author -> urls), built from the store on first
+# use and then kept current by update_metadata / transfer_metadata
+metadata_indexes = {}
+def get_metadata_index(filename: str = METADATA_FILE) -> MetadataIndex:
+    collection = collection_name(filename)
+    with metadata_lock:
+        if collection not in metadata_indexes:
+            metadata_indexes[collection] = MetadataIndex(get_metadata_store().items(collection))
+        return metadata_indexes[collection]
+
+def collection_name(filename: str) -> str:
+    """Store collection that stands in for an old metadata JSON file."""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def write_metadata(filename: str = METADATA_FILE):
+    """Export the current run's metadata to JSON. Records are already persisted
+    by update_metadata, so this is only needed for tools reading the file."""
+    with metadata_lock:
+        get_metadata_store().export_json(collection_name(METADATA_FILE), filename)
+
+def export_metadata(collection_filename: str, filename: str = None):
+    """Export any collection (e.g. BAD_VIDEOS_FILE) to its JSON file."""
+    get_metadata_store().export_json(collection_name(collection_filename),
+                                     filename or collection_filename)
+
+def get_collection(filename: str) -> dict:
+    """Returns {url: record} for the collection standing in for filename."""
+    return get_metadata_store().items(collection_name(filename))
+
+def clear_metadata(filename: str = METADATA_FILE):
+    """Empty a collection (and the in-memory view, for the run's own metadata)."""
+    with metadata_lock:
+        get_metadata_store().clear(collection_name(filename))
+        get_metadata_index(filename).clear()
+        if collection_name(filename) == collection_name(METADATA_FILE):
+            metadata.clear()
 
 def sync_metadata():
-    """Load from metadata file into local memory."""
+    """Load from metadata store into local memory."""
     global metadata
-    if metadata == {}:
-        with open(METADATA_FILE, 'r') as f:
-            metadata = json.load(f)
+    with metadata_lock:
+        if metadata == {}:
+            metadata = get_collection(METADATA_FILE)
 
 def update_metadata(url: str, update_key: str, update_val):
     """Add field to a video's metadata."""
     sync_metadata()
     url = clean_url(url)
-    if url not in metadata:
-        metadata[url] = {"url": url}
-    metadata[url][update_key] = update_val
+    with metadata_lock:
+        if url not in metadata:
+            metadata[url] = {"url": url}
+        metadata[url][update_key] = update_val
+        get_metadata_store().upsert(collection_name(METADATA_FILE), url, metadata[url])
+        get_metadata_index(METADATA_FILE).update(url, metadata[url])
 
 def transfer_metadata(url: str, to_filename: str):
-    """Add field to a video's metadata."""
+    """Copy a video's metadata into another collection (e.g. BAD_VIDEOS_FILE)."""
     sync_metadata()
     url = clean_url(url)
-    with open(to_filename, 'r') as f:
-        to_file = json.load(f)
-    to_file[url] = metadata[url]
-    with open(to_filename, 'w') as f:
-        json.dump(to_file, f)
+    with metadata_lock:
+        get_metadata_store().upsert(collection_name(to_filename), url, metadata[url])
+        get_metadata_index(to_filename).update(url, metadata[url])
 
 def get_metadata(url: str):
     """Returns metadata object given url identifier."""
     url = clean_url(url)
+    if url not in metadata:
+        record = get_metadata_store().get(collection_name(METADATA_FILE), url)
+        if record is not None:
+            metadata[url] = record
     return metadata[url]
 
-def get_metadata_by_author(author_id: str):
-    for url, data in metadata.items():
-        if data["author_id"] == author_id:
-            return data
-    return {}
+def get_metadata_by_author(username: str, filename: str = METADATA_FILE):
+    """Returns metadata of one video by the given author, or {}."""
+    urls = get_urls_by_author(username, filename)
+    if not urls:
+        return {}
+    url = min(urls)
+    if filename == METADATA_FILE:
+        return get_metadata(url)
+    return get_metadata_store().get(collection_name(filename), url)
+
+def get_urls_by_author(username: str, filename: str = METADATA_FILE) -> set:
+    """Urls of all videos by the given author."""
+    with metadata_lock:
+        return get_metadata_index(filename).urls_by_author(username)
 
 ### Download video
 
+@timed()
 def download_video(url: str):
     """Download TikTok video."""
-    metadata_path = os.path.join(DATA_DIR, hash_url(url) + "_metadata.json")
     paths = save_tiktok(
         url,
         True,
-        metadata_path,
-        PYK_BROWSER,
+        browser_name=PYK_BROWSER,
         return_fns=True,
+        video_dir=DATA_DIR,
+        return_record=True,
     )
 
-    # write local video path
-    video_path, metadata_path = paths["video_fn"], paths["metadata_fn"]
-    os.makedirs(DATA_DIR, exist_ok=True)
-    video_filename = os.path.basename(video_path)
-    new_video_path = os.path.join(DATA_DIR, video_filename)
-    os.rename(video_path, new_video_path)
-    update_metadata(url, "local_video_path", new_video_path)
+    # write local video path (streamed straight into DATA_DIR)
+    update_metadata(url, "local_video_path", paths["video_fn"])
 
-    # write video metadata
-    video_metadata = get_video_metadata(metadata_path, single_video=True)
+    # write video metadata, straight from the extracted record
+    video_metadata = video_metadata_from_row(paths["record"])
     update_metadata(url, "username", video_metadata["author"]["username"])
     update_metadata(url, "timestamp", video_metadata["timestamp"])
     update_metadata(url, "stats", video_metadata["stats"])
     update_metadata(url, "description", video_metadata["description"])
     update_metadata(url, "location", video_metadata["location"])
-    os.remove(metadata_path)
+
+def video_metadata_from_row(row: dict) -> dict:
+    """Shapes one pyktok metadata row (a CSV row or an extracted record) for global metadata."""
+    return {
+        'video_id': row['video_id'],
+        'timestamp': row['video_timestamp'],
+        'stats': {
+            'duration': int(row['video_duration']),
+            'likes': int(row['video_diggcount']),
+            'shares': int(row['video_sharecount']), 
+            'comments': int(row['video_commentcount']),
+            'plays': int(row['video_playcount'])
+        },
+        'author': {
+            'username': row['author_username'],
+            'name': row['author_name']
+        },
+        'description': row['video_description'],
+        'location': row['video_locationcreated']
+    }
 
 def get_video_metadata(metadata_path: str, single_video: bool = False):
     """Extracts info from a video's metadata csv and writes to global metadata."""
     video_data = {}
     with open(metadata_path, encoding="utf8") as f:
         reader = csv.DictReader(f)
-        # there's just one row, but we read them all anyway
         for row in reader:
             vid = row['video_id']
             if vid not in video_data:
-                video_data[vid] = {
-                    'video_id': row['video_id'],
-                    'timestamp': row['video_timestamp'],
-                    'stats': {
-                        'duration': int(row['video_duration']),
-                        'likes': int(row['video_diggcount']),
-                        'shares': int(row['video_sharecount']), 
-                        'comments': int(row['video_commentcount']),
-                        'plays': int(row['video_playcount'])
-                    },
-                    'author': {
-                        'username': row['author_username'],
-                        'name': row['author_name']
-                    },
-                    'description': row['video_description'],
-                    'location': row['video_locationcreated']
-                }
+                video_data[vid] = video_metadata_from_row(row)
     return video_data if not single_video else list(video_data.values())[0]
 
 ### Extract comments
@@ -174,6 +329,7 @@ def get_comment_data(comment):
         'is_top_list_marked': ('top_list' in comment.sort_tags)
     }
 
+@timed()
 def extract_comments(url: str, n=30):
     """Takes url and adds comments to video metadata."""
     comments_df = save_tiktok_comments(
@@ -187,8 +343,29 @@ def extract_comments(url: str, n=30):
 
 ### Transcribe video
 
-def transcribe_mp4(url: str):
-    """Takes url and adds transcription to video metadata."""
+# Only transcribe the first this-many seconds of each video (None = all of it)
+MAX_AUDIO_SECONDS = None
+
+def has_local_video(url: str) -> bool:
+    """Whether a video's downloaded file is still on disk."""
+    video_path = get_metadata(url).get("local_video_path")
+    return bool(video_path) and os.path.exists(video_path)
+
+def remove_local_video(url: str):
+    """Deletes a video's downloaded file. Only call this once its transcript is stored."""
+    if has_local_video(url):
+        os.remove(get_metadata(url)["local_video_path"])
+
+@timed()
+def prepare_audio(url: str, max_audio_seconds: float = MAX_AUDIO_SECONDS):
+    """Takes url and extracts the audio to transcribe.
+
+    The video is kept, so a failed transcription can be retried from it;
+    remove_local_video deletes it once the transcript is stored.
+
+    Returns None (with the transcript already in metadata) if the transcript
+    cache already knows this video or audio, or False without metadata.
+    """
     try:
         video_metadata = get_metadata(url)
     except:
@@ -197,23 +374,70 @@ def transcribe_mp4(url: str):
 
     url = video_metadata["url"]
     video_path = video_metadata["local_video_path"]
+    # Re-uploads of the same clip are common, so check the cache by video id
+    # first (skips extraction entirely), then by a hash of the audio itself
+    cache = get_transcript_cache()
+    video_id = video_id_from_url(url)
+    transcript_text = cache.get_by_video_id(video_id) if video_id else None
+    audio = None
+    if transcript_text is None:
+        audio_bytes = extract_audio(video_path, max_seconds=max_audio_seconds)
+        audio_hash = hash_audio(audio_bytes)
+        transcript_text = cache.get_by_audio_hash(audio_hash, video_id)
+        if transcript_text is None:
+            audio = {"audio_bytes": audio_bytes, "audio_hash": audio_hash, "video_id": video_id}
+
+    if transcript_text is not None:
+        update_metadata(url, "transcript", transcript_text)
+    return audio
+
+@timed()
+def transcribe_audio(url: str, audio: dict):
+    """Takes url and audio from prepare_audio, and adds Whisper transcription to video metadata."""
     client = get_openai_client()
-    video = VideoFileClip(video_path)
-    audio_filename = video_path.replace('.mp4', '.mp3')
-
-    video.audio.write_audiofile(audio_filename)
-    transcript = ""
-    with open(audio_filename, "rb") as audio_file:
-        transcript = client.audio.transcriptions.create(
-            file=audio_file,
-            model="whisper-1",
-        )
+    get_metrics().add(audio_seconds=audio_seconds(audio["audio_bytes"]))
+    transcript = openai_call(
+        "openai-audio",
+        client.audio.transcriptions.create,
+        file=(AUDIO_FILENAME, audio["audio_bytes"]),
+        model="whisper-1",
+    )
+    get_transcript_cache().put(audio["audio_hash"], transcript.text, audio["video_id"])
+    update_metadata(url, "transcript", transcript.text)
 
+@timed()
+def transcribe_mp4(url: str, max_audio_seconds: float = MAX_AUDIO_SECONDS):
+    """Takes url and adds transcription to video metadata."""
+    audio = prepare_audio(url, max_audio_seconds)
+    if audio is False:
+        return False
+    if audio is not None:
+        transcribe_audio(url, audio)
+    remove_local_video(url)
+
+@timed()
+async def transcribe_audio_async(url: str, audio: dict):
+    """transcribe_audio with the Whisper upload on the async client."""
+    client = get_async_openai_client()
+    get_metrics().add(audio_seconds=audio_seconds(audio["audio_bytes"]))
+    transcript = await openai_call_async(
+        "openai-audio",
+        client.audio.transcriptions.create,
+        file=(AUDIO_FILENAME, audio["audio_bytes"]),
+        model="whisper-1",
+    )
+    get_transcript_cache().put(audio["audio_hash"], transcript.text, audio["video_id"])
     update_metadata(url, "transcript", transcript.text)
 
-    video.close()
-    os.remove(video_path)
-    os.remove(audio_filename)
+@timed()
+async def transcribe_mp4_async(url: str, max_audio_seconds: float = MAX_AUDIO_SECONDS):
+    """transcribe_mp4 with audio extraction off the event loop and an async Whisper upload."""
+    audio = await asyncio.to_thread(prepare_audio, url, max_audio_seconds)
+    if audio is False:
+        return False
+    if audio is not None:
+        await transcribe_audio_async(url, audio)
+    remove_local_video(url)
 
 ### Get user's videos
 
@@ -228,29 +452,35 @@ def video_is_recent(video_data: dict):
     return time_diff_in_seconds < THREE_DAYS_OLD
 
 def get_video_urls_from_user(username: str, n=1):
-    """Takes username and returns urls of some recent videos by them."""
+    """Takes username and returns urls of some recent videos by them.
+
+    Raises if the listing or any listed video's metadata couldn't be fetched,
+    so a user isn't taken for clean just because TikTok didn't answer.
+    """
     metadata_path = os.path.join(DATA_DIR, hash_url(username) + "_videos.json")
+    failed = save_tiktok_multi_page(
+        username,
+        ent_type='user',
+        video_ct=n,
+        save_video=False,
+        metadata_fn=metadata_path,
+    )
     try:
-        save_tiktok_multi_page(
-            username,
-            ent_type='user',
-            video_ct=n,
-            save_video=False,
-            metadata_fn=metadata_path,
-        )
-    except Exception as e:
-        print(f"Error getting videos for user {username}: {e}")
-        return []
-    if not os.path.exists(metadata_path):
-        return []
-
-    video_metadata = get_video_metadata(metadata_path, single_video=False)
+        if failed:
+            url, error = next(iter(failed.items()))
+            raise RuntimeError(f"Could not get {len(failed)} videos of user {username}, e.g. {url}: {error}")
+        if not os.path.exists(metadata_path):
+            return []
+
+        video_metadata = get_video_metadata(metadata_path, single_video=False)
+    finally:
+        # the listing is only read here, so don't leave the CSV and its sidecar in DATA_DIR
+        remove_metadata_file(metadata_path)
     urls = [
         f'https://www.tiktok.com/@{username}/video/{video_id}'
         for video_id, data in video_metadata.items()
         #if video_is_recent(data)
     ]
-    #os.remove(metadata_path)
     return urls
 
 
@@ -296,25 +526,33 @@ known_narratives = """
 25. The conflict can only be resolved if Ukraine surrenders.
 """
 
-def check_disinformation(text):
-    """Takes text and returns {result: 0 or 1, narratives: list[int]}."""
-    completion = None
-    early_no = None
-    early_yes = None
-
-    # Define regex patterns for detecting "no" or "yes" conclusions.
-    no_regex = re.compile(
-        r"(?:conclusion:|in conclusion,?|ultimately,?)?\s*(?:(?:no[,.]?|the (?:text|snippet|statement) (?:does not|doesn't) contain|(?:this )?(?:statement|text|content) is not)(?!\s+elements? consistent with).*?(?:russian narratives?|russian propaganda|elements? of (?:russian )?propaganda|propagandistic elements?)|\b(?:not propaganda|isn'?t propaganda)\b).*?(?:\.|$)",
-        re.IGNORECASE,
-    )
-    yes_regex = re.compile(
-        r"(?:conclusion:|in conclusion,?|ultimately,?)?\s*(?:yes[,.]?|the (?:text|snippet|statement) (?:does contain|contains)(?:\s+elements? consistent with)?|(?:this )?(?:statement|text|content) is).*?(?:russian narratives?|russian propaganda|elements? of (?:russian )?propaganda|propagandistic elements?).*?(?:\.|$)",
-        re.IGNORECASE,
-    )
-
-    client = get_openai_client()
-    # Use a short unstructured chain-of-thought approach
-    completion = client.chat.completions.create(
+def narrow_narratives(narrative_numbers: list[int] = None) -> str:
+    """The known_narratives block, restricted to the given numbers (all of them if None)."""
+    if not narrative_numbers:
+        return known_narratives
+    narratives = parse_narratives(known_narratives)
+    return "\n" + "\n".join(f"{n}. {narratives[n]}" for n in sorted(narrative_numbers) if n in narratives) + "\n"
+
+# Patterns for an early "no" or "yes" conclusion in the chain-of-thought answer
+NO_REGEX = re.compile(
+    r"(?:conclusion:|in conclusion,?|ultimately,?)?\s*(?:(?:no[,.]?|the (?:text|snippet|statement) (?:does not|doesn't) contain|(?:this )?(?:statement|text|content) is not)(?!\s+elements? consistent with).*?(?:russian narratives?|russian propaganda|elements? of (?:russian )?propaganda|propagandistic elements?)|\b(?:not propaganda|isn'?t propaganda)\b).*?(?:\.|$)",
+    re.IGNORECASE,
+)
+YES_REGEX = re.compile(
+    r"(?:conclusion:|in conclusion,?|ultimately,?)?\s*(?:yes[,.]?|the (?:text|snippet|statement) (?:does contain|contains)(?:\s+elements? consistent with)?|(?:this )?(?:statement|text|content) is).*?(?:russian narratives?|russian propaganda|elements? of (?:russian )?propaganda|propagandistic elements?).*?(?:\.|$)",
+    re.IGNORECASE,
+)
+
+# Instructions for getting Russian narratives (the list shown may be narrowed
+# to a few candidates, so don't promise the model a fixed range of numbers)
+RUSSIAN_NARRATIVES_INSTRUCTIONS = (
+    "the known Russian narratives present in the text (at most 3), each in 3-8 words, "
+    "then match each with its narrative number from the list above"
+)
+
+def cot_request(text: str) -> dict:
+    """First call: a short unstructured chain-of-thought verdict."""
+    return dict(
         model="gpt-4o-mini",
         messages=[
             {
@@ -335,104 +573,406 @@ def check_disinformation(text):
         ],
     )
 
-    cot_analysis = completion.choices[0].message.content.strip()
+def early_conclusion(cot_analysis: str):
+    """"no" or "yes" if the chain of thought already settles it, else None."""
+    if NO_REGEX.search(cot_analysis):
+        return "no"
+    if YES_REGEX.search(cot_analysis):
+        return "yes"
+    return None
+
+def narratives_request(text: str, cot_analysis: str, candidate_narratives: str) -> dict:
+    """Follow-up after an early yes: just ask for the narratives."""
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a Russian propaganda detector. Respond concisely with the narratives present in JSON format.",
+            },
+            {
+                "role": "user",
+                "content": f"""
+                Here's a transcript from a video:
+                <text>
+                {text}
+                </text>
+        
+                Your previous analysis showed that the video contains Russian narratives:
+                <analysis>
+                {cot_analysis}
+                </analysis>
+
+                Here is a list of known Russian narratives:
+                <known_narratives>
+                {candidate_narratives}
+                </known_narratives>
+
+                Write a concise list of {RUSSIAN_NARRATIVES_INSTRUCTIONS}.
+                """,
+            },
+        ],
+        response_format=DisinformationResponseOnlyNarratives,
+    )
 
-    # Check for early "no" or "yes" conclusions
-    early_no = no_regex.search(cot_analysis)
-    early_yes = yes_regex.search(cot_analysis)
+def result_request(text: str, cot_analysis: str, candidate_narratives: str) -> dict:
+    """Follow-up without an early answer: ask for a 0/1 verdict and the narratives."""
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a Russian propaganda detector. Respond concisely in JSON format.",
+            },
+            {
+                "role": "user",
+                "content": f"""
+                Here's a transcript from a video:
+                <text>
+                {text}
+                </text>
+        
+                Here is your previous analysis of whether it contains Russian narratives:
+                {cot_analysis}
+
+                Here is a list of known Russian narratives:
+                <known_narratives>
+                {candidate_narratives}
+                </known_narratives>
+        
+                Based on the text and your previous analysis, respond 1 if there is Russian propaganda; respond 0 if not, or if it is ambiguous.
+
+                Then write a concise list of {RUSSIAN_NARRATIVES_INSTRUCTIONS}.
+                """,
+            },
+        ],
+        response_format=DisinformationResponseWithResult,
+    )
 
-    if early_no:
-        return {"result": 0, "narratives": []}
+@timed()
+def check_disinformation(text, narrative_numbers: list[int] = None):
+    """Takes text and returns {result: 0 or 1, narratives: list[int]}.
 
-    # Instructions for getting Russian narratives
-    russian_narratives_instructions = (
-        "2-3 known Russian narratives present in the text in 3-8 words, then match with the corresponding narrative number (1-25)"
-    )
+    If narrative_numbers is given, only those known narratives are shown to the model.
+    """
+    candidate_narratives = narrow_narratives(narrative_numbers)
+    client = get_openai_client()
+    completion = openai_call("openai-chat", client.chat.completions.create, **cot_request(text))
+    cot_analysis = completion.choices[0].message.content.strip()
 
-    if early_yes:
+    conclusion = early_conclusion(cot_analysis)
+    if conclusion == "no":
+        return {"result": 0, "narratives": []}
+    if conclusion == "yes":
         # If early yes, ask for the narratives directly
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a Russian propaganda detector. Respond concisely with the narratives present in JSON format.",
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                    Here's a transcript from a video:
-                    <text>
-                    {text}
-                    </text>
-            
-                    Your previous analysis showed that the video contains Russian narratives:
-                    <analysis>
-                    {cot_analysis}
-                    </analysis>
-
-                    Here is a list of known Russian narratives:
-                    <known_narratives>
-                    {known_narratives}
-                    </known_narratives>
-
-                    Write a concise list of {russian_narratives_instructions}.
-                    """,
-                },
-            ],
-            response_format=DisinformationResponseOnlyNarratives,
-        )
-        response_json = completion.choices[0].message.content
-        response_dict = json.loads(response_json)
+        completion = openai_call("openai-chat", client.beta.chat.completions.parse,
+                                 **narratives_request(text, cot_analysis, candidate_narratives))
+        response_dict = json.loads(completion.choices[0].message.content)
         response_dict["result"] = 1  # Set the result to 1 for "yes" answers
         return response_dict
-    else:
-        # If not an early yes, ask for further analysis
-        completion = client.beta.chat.completions.parse(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a Russian propaganda detector. Respond concisely in JSON format.",
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                    Here's a transcript from a video:
-                    <text>
-                    {text}
-                    </text>
-            
-                    Here is your previous analysis of whether it contains Russian narratives:
-                    {cot_analysis}
-
-                    Here is a list of known Russian narratives:
-                    <known_narratives>
-                    {known_narratives}
-                    </known_narratives>
-            
-                    Based on the text and your previous analysis, respond 1 if there is Russian propaganda; respond 0 if not, or if it is ambiguous.
-
-                    Then write a concise list of {russian_narratives_instructions}.
-                    """,
-                },
-            ],
-            response_format=DisinformationResponseWithResult,
-        )
-        response_json = completion.choices[0].message.content
-        return json.loads(response_json)
+    # If not an early yes, ask for further analysis
+    completion = openai_call("openai-chat", client.beta.chat.completions.parse,
+                             **result_request(text, cot_analysis, candidate_narratives))
+    return json.loads(completion.choices[0].message.content)
+
+@timed()
+async def check_disinformation_async(text, narrative_numbers: list[int] = None):
+    """check_disinformation on the async client, so many videos' calls can overlap on one loop."""
+    candidate_narratives = narrow_narratives(narrative_numbers)
+    client = get_async_openai_client()
+    completion = await openai_call_async("openai-chat", client.chat.completions.create, **cot_request(text))
+    cot_analysis = completion.choices[0].message.content.strip()
 
-def tag_narratives(url):
-    """Takes video url and reads its transcript to tag with disinformation narratives."""
-    metadata = get_metadata(url)
-    transcript = metadata["transcript"]
-    result = check_disinformation(transcript)
+    conclusion = early_conclusion(cot_analysis)
+    if conclusion == "no":
+        return {"result": 0, "narratives": []}
+    if conclusion == "yes":
+        completion = await openai_call_async("openai-chat", client.beta.chat.completions.parse,
+                                             **narratives_request(text, cot_analysis, candidate_narratives))
+        response_dict = json.loads(completion.choices[0].message.content)
+        response_dict["result"] = 1
+        return response_dict
+    completion = await openai_call_async("openai-chat", client.beta.chat.completions.parse,
+                                         **result_request(text, cot_analysis, candidate_narratives))
+    return json.loads(completion.choices[0].message.content)
+
+### Short-circuit and cache check_disinformation results
+
+# Bump whenever the prompts in check_disinformation change, so cached
+# results from the old prompts are no longer used
+PROMPT_VERSION = 2
+# Transcripts with fewer real words than this can't carry a narrative
+MIN_TRANSCRIPT_WORDS = 5
+# What Whisper emits for music, silence and other non-speech audio
+NON_SPEECH_WORDS = {"music", "playing", "applause", "laughter", "silence", "inaudible"}
+
+# Local pre-classifier: when on, only transcripts at least this similar to
+# some known narrative are sent to the LLM (about just the closest
+# narratives), and the rest are tagged clean. Off by default: the threshold
+# is not calibrated on labelled transcripts, and word overlap with the
+# one-line narratives misses plain paraphrases ("the Kyiv regime is run by
+# nazis" scores ~0.11 against narrative 4).
+USE_PRECLASSIFIER = os.getenv("USE_PRECLASSIFIER", "0") == "1"
+PRECLASSIFIER_THRESHOLD = 0.12
+
+narrative_classifier = None
+def get_narrative_classifier():
+    global narrative_classifier
+    if narrative_classifier == None:
+        narrative_classifier = NarrativeClassifier(known_narratives, threshold=PRECLASSIFIER_THRESHOLD)
+    return narrative_classifier
+
+disinformation_cache = None
+def get_disinformation_cache():
+    global disinformation_cache
+    if disinformation_cache == None:
+        disinformation_cache = ResultCache()
+    return disinformation_cache
+
+def normalize_transcript(text: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace."""
+    return " ".join(re.findall(r"\w+", (text or "").lower()))
+
+def is_trivial_transcript(text: str) -> bool:
+    """Whether a transcript is empty, music-only or too short to tag."""
+    words = [w for w in normalize_transcript(text).split() if w not in NON_SPEECH_WORDS]
+    return len(words) < MIN_TRANSCRIPT_WORDS
+
+def disinformation_cache_key(text: str, prompt_version=PROMPT_VERSION) -> str:
+    """Cache key covering the transcript, the narrative list and the prompt version."""
+    narratives_hash = hashlib.sha256(known_narratives.encode()).hexdigest()
+    preclassifier = PRECLASSIFIER_THRESHOLD if USE_PRECLASSIFIER else "off"
+    key_material = f"{prompt_version}\0{narratives_hash}\0{preclassifier}\0{normalize_transcript(text)}"
+    return hashlib.sha256(key_material.encode()).hexdigest()
+
+def precheck_disinformation(text, prompt_version=PROMPT_VERSION):
+    """Everything check_disinformation_cached does short of asking the model.
+
+    Returns (result, cache key, candidate narrative numbers). result is None
+    if the model has to be asked, about just the candidates (or every known
+    narrative if candidates is None).
+    """
+    if is_trivial_transcript(text):
+        return {"result": 0, "narratives": []}, None, None
+    cache = get_disinformation_cache()
+    key = disinformation_cache_key(text, prompt_version)
+    result = cache.get(key)
+    if result is not None or not USE_PRECLASSIFIER:
+        return result, key, None
+    score, candidates = get_narrative_classifier().score(text)
+    if score < PRECLASSIFIER_THRESHOLD:
+        result = {"result": 0, "narratives": []}
+        cache.put(key, result)
+        return result, key, None
+    return None, key, candidates
+
+def check_disinformation_cached(text):
+    """check_disinformation, skipping the model for trivial or already-seen transcripts."""
+    result, key, candidates = precheck_disinformation(text)
+    if result is None:
+        result = check_disinformation(text, narrative_numbers=candidates)
+        get_disinformation_cache().put(key, result)
+    return result
+
+async def check_disinformation_cached_async(text):
+    """check_disinformation_cached on the async client."""
+    result, key, candidates = precheck_disinformation(text)
+    if result is None:
+        result = await check_disinformation_async(text, narrative_numbers=candidates)
+        get_disinformation_cache().put(key, result)
+    return result
+
+def _record_narratives(url, result):
+    """Writes a check_disinformation result to a video's metadata, returns narrative numbers."""
     disinformation_found = result["result"] == 1
     narratives = [narrative["narrative_number"] for narrative in result["narratives"]]
     update_metadata(url, "disinformation_found", disinformation_found)
     update_metadata(url, "narratives", narratives)
     return narratives
 
+@timed()
+def tag_narratives(url):
+    """Takes video url and reads its transcript to tag with disinformation narratives."""
+    metadata = get_metadata(url)
+    transcript = metadata["transcript"]
+    result = check_disinformation_cached(transcript)
+    return _record_narratives(url, result)
+
+@timed()
+async def tag_narratives_async(url):
+    """tag_narratives on the async client."""
+    transcript = get_metadata(url)["transcript"]
+    result = await check_disinformation_cached_async(transcript)
+    return _record_narratives(url, result)
+
+### Batched narrative tagging
+
+class IndexedDisinformationResponse(DisinformationResponseWithResult):
+    index: int
+
+class BatchDisinformationResponse(BaseModel):
+    results: list[IndexedDisinformationResponse]
+
+# The single-pass batch prompt answers differently from check_disinformation's
+# chain of thought, so its results are cached under their own prompt version
+BATCH_PROMPT_VERSION = "batch-2"
+# Rough cap on transcript tokens packed into one request (the narrative list
+# and instructions come on top of this)
+BATCH_TOKEN_BUDGET = 6000
+MAX_BATCH_SIZE = 20
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+def make_batches(texts: list[str], token_budget: int = BATCH_TOKEN_BUDGET) -> list[list[int]]:
+    """Groups text indices into batches that fit the token budget."""
+    batches, batch, batch_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (batch_tokens + tokens > token_budget or len(batch) >= MAX_BATCH_SIZE):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def batch_request(texts: list[str], candidate_narratives: str) -> dict:
+    """One request judging several texts, each tagged with its index."""
+    transcripts_block = "\n".join(
+        f'<text index="{i}">\n{text}\n</text>' for i, text in enumerate(texts)
+    )
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a Russian propaganda detector. Respond concisely in JSON format.",
+            },
+            {
+                "role": "user",
+                "content": f"""
+                Here are {len(texts)} transcripts from different videos, each with an index:
+                {transcripts_block}
+
+                Here is a list of known Russian narratives:
+                <known_narratives>
+                {candidate_narratives}
+                </known_narratives>
+
+                Judge each transcript on its own. For every index, respond 1 if there is Russian propaganda; respond 0 if not, or if it is ambiguous.
+
+                Then, for the transcripts you marked 1, write a concise list of {RUSSIAN_NARRATIVES_INSTRUCTIONS}.
+                """,
+            },
+        ],
+        response_format=BatchDisinformationResponse,
+    )
+
+def parse_batch_response(content: str, n_texts: int) -> list:
+    """{result, narratives} per text, or None for any index the model dropped."""
+    results = [None] * n_texts
+    for item in json.loads(content)["results"]:
+        if 0 <= item["index"] < n_texts:
+            results[item["index"]] = {"result": item["result"], "narratives": item["narratives"]}
+    return results
+
+def check_disinformation_batch(texts: list[str], narrative_numbers: list[int] = None) -> list:
+    """Takes several texts and returns a {result, narratives} dict for each, in one request.
+
+    Texts the model skipped come back as None. If narrative_numbers is given,
+    only those known narratives are shown to the model.
+    """
+    client = get_openai_client()
+    completion = openai_call("openai-chat", client.beta.chat.completions.parse,
+                             **batch_request(texts, narrow_narratives(narrative_numbers)))
+    return parse_batch_response(completion.choices[0].message.content, len(texts))
+
+async def check_disinformation_batch_async(texts: list[str], narrative_numbers: list[int] = None) -> list:
+    """check_disinformation_batch on the async client."""
+    client = get_async_openai_client()
+    completion = await openai_call_async("openai-chat", client.beta.chat.completions.parse,
+                                         **batch_request(texts, narrow_narratives(narrative_numbers)))
+    return parse_batch_response(completion.choices[0].message.content, len(texts))
+
+def precheck_narrative_batch(urls: list[str]):
+    """Everything tag_narratives_batch does short of asking the model.
+
+    Returns (results, pending): results is {url: result} for the urls settled
+    without the model, pending is {cache key: (transcript, candidate
+    narrative numbers, urls sharing it)} for the transcripts left to ask about.
+    """
+    results, pending = {}, {}
+    for url in urls:
+        transcript = get_metadata(url)["transcript"]
+        key = disinformation_cache_key(transcript, BATCH_PROMPT_VERSION)
+        if key in pending:
+            pending[key][2].append(url)
+            continue
+        result, _, candidates = precheck_disinformation(transcript, BATCH_PROMPT_VERSION)
+        if result is not None:
+            results[url] = result
+        else:
+            pending[key] = (transcript, candidates, [url])
+    return results, pending
+
+def narrative_batches(pending: dict, token_budget: int = BATCH_TOKEN_BUDGET):
+    """Splits precheck_narrative_batch's pending transcripts into requests.
+
+    Yields (cache keys, texts, narrative numbers to show) per request. The
+    narratives shown are every candidate of the batch's texts, or all of
+    them if some text has no candidates.
+    """
+    keys = list(pending)
+    for batch in make_batches([pending[key][0] for key in keys], token_budget):
+        batch_keys = [keys[i] for i in batch]
+        candidates = [pending[key][1] for key in batch_keys]
+        if any(c is None for c in candidates):
+            narrative_numbers = None
+        else:
+            narrative_numbers = sorted(set().union(*candidates))
+        yield batch_keys, [pending[key][0] for key in batch_keys], narrative_numbers
+
+@timed()
+def tag_narratives_batch(urls: list[str], token_budget: int = BATCH_TOKEN_BUDGET) -> dict:
+    """Tags many videos, packing uncached transcripts into shared requests.
+
+    Returns {url: narrative numbers}.
+    """
+    results, pending = precheck_narrative_batch(urls)
+    for keys, texts, narrative_numbers in narrative_batches(pending, token_budget):
+        batch_results = check_disinformation_batch(texts, narrative_numbers)
+        for key, text, result in zip(keys, texts, batch_results):
+            if result is None:
+                # the model occasionally drops an item; ask about it on its own
+                result = check_disinformation_cached(text)
+            else:
+                get_disinformation_cache().put(key, result)
+            for url in pending[key][2]:
+                results[url] = result
+    return {url: _record_narratives(url, results[url]) for url in urls}
+
+@timed()
+async def tag_narratives_batch_async(urls: list[str], token_budget: int = BATCH_TOKEN_BUDGET) -> dict:
+    """tag_narratives_batch on the async client."""
+    results, pending = precheck_narrative_batch(urls)
+
+    async def run_batch(keys, texts, narrative_numbers):
+        batch_results = await check_disinformation_batch_async(texts, narrative_numbers)
+        for key, text, result in zip(keys, texts, batch_results):
+            if result is None:
+                result = await check_disinformation_cached_async(text)
+            else:
+                get_disinformation_cache().put(key, result)
+            for url in pending[key][2]:
+                results[url] = result
+
+    # requests that don't fit one token budget go out side by side
+    await asyncio.gather(*[run_batch(*batch) for batch in narrative_batches(pending, token_budget)])
+    return {url: _record_narratives(url, results[url]) for url in urls}
+
 
 ### Test case if run as main
 